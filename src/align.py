@@ -0,0 +1,127 @@
+"""
+LLM-free alternative to qspan for subquestions that (nearly) literally occur in the original: a local alignment
+(Smith-Waterman) of the subquestion's words to the original's words, allowing words of the original to be skipped,
+so the resulting spans can be discontinuous.
+"""
+
+import re
+import difflib
+import functools
+
+from metrics import METRICS
+
+WORD_REGEX = re.compile(r'\w+')
+
+MATCH_THRESHOLD = .8    # minimal string similarity for two words to count as a match
+SKIP_ORIGINAL_PENALTY = .4
+SKIP_REPHRASED_PENALTY = .6
+
+
+def align_quote(original: str, rephrased: str, only_from_char=0, already_used=None) -> tuple[list[dict] | None, float]:
+    """
+    Returns the spans of the original that the rephrased subquestion aligns to (in the same format as
+    parse_string_quote_as_spans), and a confidence: the proportion of the subquestion's words that were matched.
+    Words inside spans in already_used can't be matched; the whole span found is added to it.
+
+    >>> align_quote('Sinds wanneer geldt deze maatregel en wat was destijds de motivatie?', 'Wat was destijds de motivatie?')
+    ([{'start': 38, 'end': 68, 'text': 'wat was destijds de motivatie?'}], 1.0)
+    >>> align_quote('Hoevaak en wanneer nemen mensen in Nederland de fiets?', 'Hoevaak nemen mensen in Nederland de fiets?')
+    ([{'start': 0, 'end': 7, 'text': 'Hoevaak'}, {'start': 19, 'end': 54, 'text': 'nemen mensen in Nederland de fiets?'}], 1.0)
+    >>> spans, confidence = align_quote('Heeft u de brief gelezen, en zoja, wat is uw reactie?', 'Wat is uw reactie op de brief van de Indonesische overheid?')
+    >>> spans, round(confidence, 2)
+    ([{'start': 35, 'end': 53, 'text': 'wat is uw reactie?'}], 0.36)
+    >>> used = []
+    >>> align_quote('Wie ben je? Wie ben je?', 'Wie ben je?', already_used=used)[0], align_quote('Wie ben je? Wie ben je?', 'Wie ben je?', already_used=used)[0]
+    ([{'start': 0, 'end': 11, 'text': 'Wie ben je?'}], [{'start': 12, 'end': 23, 'text': 'Wie ben je?'}])
+    """
+    original_words = [match for match in WORD_REGEX.finditer(original) if match.start() >= only_from_char
+                      and not any(start <= match.start() < end for start, end in already_used or [])]
+    rephrased_words = [word.lower() for word in WORD_REGEX.findall(rephrased)]
+    if not original_words or not rephrased_words:
+        return None, 0.0
+
+    scores, best_cell = local_alignment([match.group().lower() for match in original_words], rephrased_words)
+    matched = traceback(scores, best_cell, [match.group().lower() for match in original_words], rephrased_words)
+    if not matched:
+        return None, 0.0
+
+    spans = []
+    for i in matched:
+        start, end = original_words[i].span()
+        if spans and spans[-1]['last_word'] == i - 1:
+            spans[-1].update(end=end, last_word=i)
+        else:
+            spans.append({'start': start, 'end': end, 'last_word': i})
+    if rephrased.rstrip().endswith('?') and original[spans[-1]['end']:spans[-1]['end'] + 1] == '?':
+        spans[-1]['end'] += 1
+
+    spans = [{'start': span['start'], 'end': span['end'], 'text': original[span['start']:span['end']]} for span in spans]
+    if already_used is not None:
+        already_used.append((spans[0]['start'], spans[-1]['end']))
+
+    return spans, len(matched) / len(rephrased_words)
+
+
+@METRICS.stage('align')
+def align_quotes(original: str, rephrased_list: list[str], align_threshold: float, only_from_char=0, already_used=None) -> list:
+    """
+    Align each rephrased subquestion in turn (so already_used disambiguation applies in order), returning its spans
+    if the confidence is at least align_threshold, otherwise None.
+    """
+    used = list(already_used or [])
+    aligned = []
+    for rephrased in rephrased_list:
+        spans, confidence = align_quote(original, rephrased, only_from_char=only_from_char, already_used=used)
+        aligned.append(spans if spans is not None and confidence >= align_threshold else None)
+    return aligned
+
+
+def align_windows(windows, align_threshold: float) -> list[list]:
+    """
+    align_quotes for each of qsep's windows (original_text, char_offset, subquestions); for running in a worker process.
+    """
+    return [align_quotes(original_text, subquestions, align_threshold) for original_text, char_offset, subquestions in windows]
+
+
+@functools.lru_cache(maxsize=100_000)
+def word_similarity(word1, word2):
+    if word1 == word2:
+        return 1.0
+    similarity = difflib.SequenceMatcher(None, word1, word2).ratio()
+    return similarity if similarity >= MATCH_THRESHOLD else -1.0
+
+
+def local_alignment(original_words, rephrased_words):
+    """
+    Smith-Waterman: scores[i][j] is the best score of an alignment ending at original word i-1 and rephrased word j-1.
+    """
+    scores = [[0.0] * (len(rephrased_words) + 1) for _ in range(len(original_words) + 1)]
+    best_cell, best_score = (0, 0), 0.0
+    for i, original_word in enumerate(original_words, start=1):
+        for j, rephrased_word in enumerate(rephrased_words, start=1):
+            score = max(0.0,
+                        scores[i - 1][j - 1] + word_similarity(original_word, rephrased_word),
+                        scores[i - 1][j] - SKIP_ORIGINAL_PENALTY,
+                        scores[i][j - 1] - SKIP_REPHRASED_PENALTY)
+            scores[i][j] = score
+            if score > best_score:
+                best_cell, best_score = (i, j), score
+    return scores, best_cell
+
+
+def traceback(scores, best_cell, original_words, rephrased_words) -> list[int]:
+    """
+    Indices of the original words that are matched in the best local alignment, in order.
+    """
+    i, j = best_cell
+    matched = []
+    while i > 0 and j > 0 and scores[i][j] > 0:
+        similarity = word_similarity(original_words[i - 1], rephrased_words[j - 1])
+        if similarity > 0 and scores[i][j] == scores[i - 1][j - 1] + similarity:
+            matched.append(i - 1)
+            i, j = i - 1, j - 1
+        elif scores[i][j] == scores[i - 1][j] - SKIP_ORIGINAL_PENALTY:
+            i -= 1
+        else:
+            j -= 1
+    return matched[::-1]
@@ -0,0 +1,284 @@
+"""
+Generation backends: what qsep and qspan call 'pipe'. A backend has default generation settings (temperature,
+top_p, max_new_tokens) and a generate method returning, per chat, a list of n_candidates replies (strings), each
+cut off where the stop condition (if any; see constraints.py) says it's complete. A backend can also count_tokens, for
+deriving max_new_tokens from the input (see llm_utils.token_budget):
+
+- PipelineBackend: an in-process transformers text-generation pipeline;
+- HTTPBackend: an OpenAI-compatible server (e.g., vLLM or llama.cpp's server, which do continuous batching), with
+  many requests in flight at once over a pool of keep-alive connections;
+- FakeBackend: a deterministic stand-in for a model (--model test), for testing and benchmarking offline.
+
+For testing HTTPBackend without a model, run_stub_server starts a local server that echoes (or otherwise derives)
+its replies.
+"""
+
+import re
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import http.client
+import http.server
+import urllib.parse
+import concurrent.futures
+
+from constraints import make_logits_processor, cut_at_stop, StopWhenComplete, LineStop
+from llm_utils import PREFIX_CACHES, find_prefix_cache, prepare_for_batching, chat_input_ids
+from metrics import METRICS
+
+
+class PipelineBackend:
+
+    def __init__(self, generator, **settings):
+        self.generator = generator
+        self.model_name = generator.model.name_or_path
+        self.settings = settings
+
+    def count_tokens(self, text):
+        return len(self.generator.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def generate(self, chats, n_candidates=1, batch_size=None, grammar=None, stop=None, **settings):
+        if PREFIX_CACHES and len(chats) > 1 and any(find_prefix_cache(self, chat) for chat in chats):
+            # a prefix cache only fits unbatched generation (see llm_utils.PrefixCache), so use it one chat at a time:
+            return [self.generate([chat], n_candidates, grammar=grammar, stop=stop, **settings)[0] for chat in chats]
+        kwargs = {**self.settings, **settings}
+        if n_candidates > 1:
+            kwargs.update(num_return_sequences=n_candidates, do_sample=True)
+        if grammar is not None:
+            kwargs.update(logits_processor=[make_logits_processor(self.generator, grammar)])
+        if stop is not None:
+            kwargs.update(stopping_criteria=[StopWhenComplete(self.generator.tokenizer, stop)])
+        if PREFIX_CACHES and len(chats) == 1 and (prefix_cache := find_prefix_cache(self, chats[0])):
+            kwargs.update(past_key_values=prefix_cache.fresh_copy(n_candidates))
+        outputs = self.generator(chats, batch_size=batch_size or len(chats), **kwargs)
+        replies = [[cut_at_stop(candidate['generated_text'][-1]['content'], stop) for candidate in output] for output in outputs]
+        if METRICS.enabled:
+            tokenizer = self.generator.tokenizer
+            METRICS.count('prompt_tokens', sum(len(chat_input_ids(tokenizer, chat)) for chat in chats))
+            METRICS.count('generated_tokens', sum(len(tokenizer(reply, add_special_tokens=False).input_ids) for candidates in replies for reply in candidates))
+        return replies
+
+
+class HTTPBackend:
+    """
+    Sends each chat as a separate request to an OpenAI-compatible /v1/chat/completions endpoint, up to max_in_flight
+    at a time, leaving the batching to the server. Constrained decoding (grammar) isn't supported; of the stop
+    conditions, only LineStop is passed on to the server (as stop string '\\n', so a reply that starts with an
+    empty line comes back empty, to be retried), the others only cut off the replies afterwards. Tokens are counted
+    by an estimate (one per two characters), as the server's tokenizer isn't at hand.
+
+    >>> server = run_stub_server()
+    >>> backend = HTTPBackend(f'http://127.0.0.1:{server.server_port}', 'stub', temperature=.1)
+    >>> backend.generate([[{'role': 'user', 'content': 'Wie?'}], [{'role': 'user', 'content': 'Wat?'}]], n_candidates=2)
+    [['Wie?', 'Wie?'], ['Wat?', 'Wat?']]
+    >>> backend.generate([[{'role': 'user', 'content': 'Wie ben je?\\nThis quote contains...'}]], stop=LineStop())
+    [['Wie ben je?']]
+    >>> server.last_request['stop']
+    ['\\n']
+    >>> server.shutdown()
+    """
+
+    def __init__(self, url, model_name, max_in_flight=32, timeout=600, **settings):
+        parsed_url = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parsed_url.scheme == 'https' else http.client.HTTPConnection
+        self.host = parsed_url.netloc
+        self.path = parsed_url.path.rstrip('/') + '/v1/chat/completions'
+        self.model_name = model_name
+        self.timeout = timeout
+        self.settings = settings
+        self.connections = queue.LifoQueue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self.warned_about_grammar = False
+
+    @staticmethod
+    def count_tokens(text):
+        return len(text) // 2 + 1
+
+    def generate(self, chats, n_candidates=1, batch_size=None, grammar=None, stop=None, **settings):
+        if grammar is not None and not self.warned_about_grammar:
+            logging.warning('Constrained decoding is not supported with an HTTP backend; ignoring it.')
+            self.warned_about_grammar = True
+        settings = {**self.settings, **settings}
+        request = {
+            'model': self.model_name,
+            'n': n_candidates,
+            'temperature': settings.get('temperature'),
+            'top_p': settings.get('top_p'),
+            'max_tokens': settings.get('max_new_tokens'),
+            'stop': ['\n'] if isinstance(stop, LineStop) else None,
+        }
+        request = {key: value for key, value in request.items() if value is not None}
+        responses = list(self.executor.map(lambda chat: self.complete({**request, 'messages': chat}), chats))
+        for replies, usage in responses:
+            METRICS.count('prompt_tokens', usage.get('prompt_tokens', 0))
+            METRICS.count('generated_tokens', usage.get('completion_tokens', 0))
+        return [[cut_at_stop(reply, stop) for reply in replies] for replies, usage in responses]
+
+    def complete(self, request) -> tuple[list[str], dict]:
+        body = json.dumps(request).encode()
+        for n_try in range(2):  # a pooled connection may have been closed by the server in the meantime
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.connection_class(self.host, timeout=self.timeout)
+            try:
+                connection.request('POST', self.path, body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response_body = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if n_try > 0:
+                    raise
+                logging.info('Reconnecting after %r', e)
+                continue
+            self.connections.put(connection)
+            if response.status != 200:
+                raise RuntimeError(f'Server responded {response.status}: {response_body[:200]}')
+            response = json.loads(response_body)
+            return [choice['message']['content'] for choice in response['choices']], response.get('usage') or {}
+
+
+class FakeBackend:
+    """
+    Replies like a model that is right most of the time: for a qsep prompt, the JSON list of the questions (ending in
+    '?') in the input; for a qspan prompt, the rephrased question as quote. Otherwise, at the given rates, a malformed
+    reply, or a right one prefaced by a line like "Here is the answer:".
+
+    Deterministic: the reply depends only on the seed, the chat, and how often the same chat was sent before (so
+    that retries can succeed). Counts calls, chats and retries, for benchmarking. Words stand in for tokens (also
+    for max_new_tokens).
+
+    >>> chat = [{'role': 'user', 'content': 'Wie ben je? En wat doe je?'}]
+    >>> [FakeBackend(malformed_rate=.3, preface_rate=.3, seed=seed).generate([chat])[0][0] for seed in range(3)]
+    ['["Wie ben je?", "En wat doe je?"]', 'Here is the answer:\\n["Wie ben je?", "En wat doe je?"]', 'I am not sure what you mean.']
+    >>> backend = FakeBackend()
+    >>> _ = backend.generate([chat, chat])
+    >>> backend.n_calls, backend.n_chats, backend.n_retries
+    (1, 2, 1)
+    """
+
+    MALFORMED = ['I am not sure what you mean.', '["Wie ben je?", "Wat', 'Subquestions: Wie ben je, wat doe je']
+    PREFACES = ['Here is the answer:', 'Sure! These are the subquestions:']
+
+    def __init__(self, malformed_rate=.1, preface_rate=.1, latency=0.0, seed=0, **settings):
+        self.malformed_rate = malformed_rate
+        self.preface_rate = preface_rate
+        self.latency = latency
+        self.seed = seed
+        self.model_name = 'test'
+        self.settings = settings
+        self.times_seen = {}
+        self.n_calls = self.n_chats = self.n_retries = 0
+
+    @staticmethod
+    def count_tokens(text):
+        return len(text.split())
+
+    def generate(self, chats, n_candidates=1, batch_size=None, grammar=None, stop=None, **settings):
+        max_new_tokens = {**self.settings, **settings}.get('max_new_tokens')
+        self.n_calls += 1
+        time.sleep(self.latency)
+        replies = []
+        for chat in chats:
+            key = json.dumps(chat)
+            n_seen = self.times_seen.get(key, 0)
+            self.times_seen[key] = n_seen + 1
+            self.n_chats += 1
+            self.n_retries += n_seen > 0
+            rng = random.Random(f'{self.seed}:{n_seen}:{key}')
+            replies.append([cut_at_stop(self.reply(chat[-1]['content'], rng, max_new_tokens), stop) for _ in range(n_candidates)])
+        METRICS.count('prompt_tokens', sum(len(message['content'].split()) for chat in chats for message in chat))
+        METRICS.count('generated_tokens', sum(len(reply.split()) for candidates in replies for reply in candidates))
+        return replies
+
+    def reply(self, prompt, rng, max_new_tokens=None):
+        roll = rng.random()
+        if roll < self.malformed_rate:
+            return rng.choice(self.MALFORMED)
+        reply = self.right_reply(prompt)
+        if roll < self.malformed_rate + self.preface_rate:
+            reply = rng.choice(self.PREFACES) + '\n' + reply
+        if max_new_tokens is not None and len(words := reply.split()) > max_new_tokens:
+            reply = ' '.join(words[:max_new_tokens])
+        return reply
+
+    @staticmethod
+    def right_reply(prompt):
+        if prompt.startswith('> ') and (match := re.search(r'as "(.*)", and no more\.$', prompt, flags=re.DOTALL)):
+            return match.group(1)   # qspan: the rephrased question is quoted literally
+        target = prompt.split('Question: ')[-1]    # qsep, focused (with context) or not
+        return json.dumps([question.strip() for question in re.findall(r'[^?]+\?', target)] or [target.strip()])
+
+
+class WithSettings:
+    """
+    A pipe with some of its generation settings overridden, e.g., by a daemon client's options.
+
+    >>> pipe = WithSettings(FakeBackend(temperature=.1, top_p=None), temperature=.3)
+    >>> pipe.settings
+    {'temperature': 0.3, 'top_p': None}
+    """
+
+    def __init__(self, backend, **settings):
+        self.backend = backend
+        self.overrides = settings
+
+    @property
+    def settings(self):
+        return {**self.backend.settings, **self.overrides}
+
+    def count_tokens(self, text):
+        return self.backend.count_tokens(text)
+
+    def generate(self, chats, n_candidates=1, batch_size=None, grammar=None, stop=None, **settings):
+        return self.backend.generate(chats, n_candidates, batch_size=batch_size, grammar=grammar, stop=stop, **{**self.overrides, **settings})
+
+
+def make_backend(model, server=None, max_in_flight=32, **settings):
+    if model == 'test':
+        return FakeBackend(**settings)
+    if server:
+        return HTTPBackend(server, model, max_in_flight=max_in_flight, **settings)
+    from transformers import pipeline
+    return PipelineBackend(prepare_for_batching(pipeline('text-generation', model=model)), **settings)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def do_POST(self):
+        request = self.server.last_request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = self.server.respond(request['messages'])
+        for stop in request.get('stop') or []:
+            content = content.split(stop)[0]
+        response = json.dumps({
+            'object': 'chat.completion',
+            'model': request.get('model'),
+            'choices': [{'index': i, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}
+                        for i in range(request.get('n', 1))],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def run_stub_server(host='127.0.0.1', port=0, respond=None):
+    """
+    Serve an OpenAI-compatible chat completions endpoint in a background thread, replying with respond(messages)
+    (by default echoing the last message), up to any stop string. Port 0 means any free port (see server.server_port);
+    server.last_request is the last request received.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.respond = respond or (lambda messages: messages[-1]['content'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
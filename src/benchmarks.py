@@ -0,0 +1,181 @@
+"""
+Benchmarks for qsep/qspan, runnable offline and on CPU:
+
+    python benchmarks.py
+
+The doctests (python -m doctest benchmarks.py) guard against regressions in import time.
+"""
+
+import os
+import sys
+import json
+import random
+import time
+import argparse
+import subprocess
+
+import qsep
+import qspan
+import parsing
+from backends import FakeBackend
+
+
+WORDS = ['de', 'het', 'een', 'minister', 'maatregel', 'brief', 'overheid', 'onderzoek', 'wanneer', 'waarom',
+         'bent', 'u', 'bekend', 'met', 'bericht', 'dat', 'steeds', 'meer', 'mensen', 'fiets', 'reactie', 'is',
+         'wat', 'hoe', 'kunt', 'aangeven', 'gemeenten', 'motivatie', 'destijds', 'openbaar', 'grondslag']
+
+
+def make_synthetic_questions(n_questions, rng, min_words=6, max_words=20):
+    questions = []
+    for _ in range(n_questions):
+        words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+        questions.append(' '.join(words).capitalize() + '?')
+    return ' '.join(questions)
+
+
+def perturb(text, n_edits, rng):
+    chars = list(text)
+    for _ in range(n_edits):
+        i = rng.randrange(len(chars))
+        operation = rng.choice(['substitute', 'delete', 'insert'])
+        if operation == 'substitute':
+            chars[i] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+        elif operation == 'delete' and len(chars) > 1:
+            del chars[i]
+        else:
+            chars.insert(i, rng.choice('abcdefghijklmnopqrstuvwxyz'))
+    return ''.join(chars)
+
+
+def make_quote_cases(n_cases, n_questions, seed=0):
+    """
+    (quote, original) pairs: exact quotes of one question, dotted quotes skipping part of one, and perturbed quotes.
+    """
+    rng = random.Random(seed)
+    cases = []
+    for n in range(n_cases):
+        original = make_synthetic_questions(n_questions, rng)
+        questions = [q.strip() + '?' for q in original.split('?') if q.strip()]
+        question = rng.choice(questions)
+        words = question.split()
+        if n % 3 == 0:
+            quote = question
+        elif n % 3 == 1:
+            cut = len(words) // 3
+            quote = ' '.join(words[:cut]) + ' ... ' + ' '.join(words[2 * cut:])
+        else:
+            quote = perturb(question, 2, rng)
+        cases.append((quote, original))
+    return cases
+
+
+def bench_qsep(n_lines=200, batch_size=1, validate=False, splitandmerge=None, align_threshold=None, malformed_rate=.1, preface_rate=.1, n_retries=5, fuzzy=.1, verbose=True):
+    """
+    Run qsep's separate_questions on synthetic lines with the fake model (see backends.FakeBackend), measuring
+    lines per second, and per line the calls to the backend, the chats sent, and how many of those were retries.
+
+    >>> stats = bench_qsep(50, batch_size=8, validate=True, verbose=False)
+    >>> stats['calls_per_line'], stats['chats_per_line'], stats['retries_per_line'], stats['failed_lines']
+    (1.74, 5.02, 0.82, 0)
+    """
+    rng = random.Random(0)
+    lines = [make_synthetic_questions(rng.randint(1, 6), rng, max_words=12) for _ in range(n_lines)]
+    backend = FakeBackend(malformed_rate=malformed_rate, preface_rate=preface_rate, temperature=.1, top_p=None, max_new_tokens=1000)
+
+    start = time.perf_counter()
+    results = qsep.separate_questions(list(enumerate(lines)), backend, n_retries, batch_size=batch_size,
+                                      splitandmerge=splitandmerge, validate=validate, validate_n_retries=n_retries,
+                                      fuzzy=fuzzy, align_threshold=align_threshold)
+    seconds = time.perf_counter() - start
+
+    stats = {
+        'lines_per_second': n_lines / seconds,
+        'calls_per_line': backend.n_calls / n_lines,
+        'chats_per_line': backend.n_chats / n_lines,
+        'retries_per_line': backend.n_retries / n_lines,
+        'failed_lines': results.count(None),
+    }
+    if verbose:
+        settings = f'batch size {batch_size}' + ', validate' * validate + f', splitandmerge {splitandmerge}' * (splitandmerge is not None) + f', align {align_threshold}' * (align_threshold is not None)
+        print(f'qsep ({settings}): {stats["lines_per_second"]:8.1f} lines/s; per line {stats["calls_per_line"]:.2f} calls, '
+              f'{stats["chats_per_line"]:.2f} chats, {stats["retries_per_line"]:.2f} retries; {stats["failed_lines"]} lines failed.')
+    return stats
+
+
+def bench_span_matching(n_cases=60, n_questions=30, fuzzy=.1):
+    """
+    Time parse_string_quote_as_spans per matcher on long synthetic inputs, and count how often they agree.
+    """
+    cases = make_quote_cases(n_cases, n_questions)
+    mean_length = sum(len(original) for quote, original in cases) / len(cases)
+    results = {}
+    for matcher in ['regex', 'fast']:
+        parsing.dotted_quote_to_regex.cache_clear()
+        outcomes = []
+        start = time.perf_counter()
+        for quote, original in cases:
+            try:
+                outcomes.append(qspan.parse_string_quote_as_spans(quote, original, fuzzy=fuzzy, already_used=[], matcher=matcher))
+            except ValueError as e:
+                outcomes.append(str(e))
+        seconds = time.perf_counter() - start
+        results[matcher] = outcomes
+        print(f'{matcher:>6}: {1000 * seconds / len(cases):8.2f} ms per quote ({mean_length:.0f} characters per original)')
+
+    n_agree = sum(a == b for a, b in zip(results['regex'], results['fast']))
+    print(f'Same result for {n_agree}/{len(cases)} quotes.')
+    return results
+
+
+# Should only be imported when a model is actually needed:
+HEAVY_MODULES = {'torch', 'transformers', 'regex', 'asyncio', 'http.client', 'numpy'}
+
+
+def imported_modules(code: str) -> set[str]:
+    """
+    The modules that running the code imports, in a fresh interpreter (with this directory on the path).
+
+    >>> sorted(imported_modules('import parsing') & HEAVY_MODULES)
+    []
+    >>> sorted(imported_modules('import qsep, qspan') & HEAVY_MODULES)
+    []
+    >>> sorted(imported_modules('import sys, qsep; sys.argv = ["qsep", "--help"]\\ntry: qsep.main()\\nexcept SystemExit: pass') & HEAVY_MODULES)
+    []
+    """
+    code = f'import sys, json\n{code}\nprint(json.dumps(sorted(sys.modules)))'
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return set(json.loads(output.splitlines()[-1]))
+
+
+def import_seconds(module: str, repeat=5) -> float:
+    """
+    Time to import the module in a fresh interpreter (best of repeat; excluding the interpreter's own startup).
+    Only reported, as it depends on the machine's load; imported_modules is what guards against slow imports.
+    """
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    return min(float(subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout)
+               for _ in range(repeat))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmarks for qsep and qspan.')
+    argparser.add_argument('--cases', type=int, default=60, help='Number of synthetic quotes to match.')
+    argparser.add_argument('--questions', type=int, default=30, help='Number of questions per synthetic original.')
+    argparser.add_argument('--fuzzy', type=float, default=.1)
+    argparser.add_argument('--lines', type=int, default=200, help='Number of synthetic lines for qsep with the fake model.')
+    argparser.add_argument('--malformed', type=float, default=.1, help='Rate of malformed fake model responses.')
+    argparser.add_argument('--preface', type=float, default=.1, help='Rate of fake model responses prefaced by a line like "Here is the answer:".')
+    args = argparser.parse_args()
+
+    for module in ['parsing', 'qsep', 'qspan']:
+        print(f'import {module}: {1000 * import_seconds(module):.1f} ms')
+    for settings in [dict(batch_size=1), dict(batch_size=16), dict(batch_size=16, validate=True),
+                     dict(batch_size=16, validate=True, align_threshold=.8), dict(batch_size=16, validate=True, splitandmerge=2)]:
+        bench_qsep(args.lines, malformed_rate=args.malformed, preface_rate=args.preface, fuzzy=args.fuzzy, **settings)
+    bench_span_matching(args.cases, args.questions, args.fuzzy)
+
+
+if __name__ == '__main__':
+    main()
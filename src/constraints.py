@@ -0,0 +1,328 @@
+"""
+Grammar-constrained decoding: a logits processor that only lets the LLM generate text that can still be completed
+into something the parser will accept. Grammars are character-level automata with initial(), advance() and
+is_complete(); they don't depend on torch or transformers.
+
+Likewise, stop conditions end generation as soon as the reply is complete (e.g., a JSON list was closed), rather
+than letting the LLM ramble on until max_new_tokens; everything after that point would only make parsing fail.
+"""
+
+import re
+import logging
+
+from parsing import parse_json_list_of_strings
+
+
+class JsonListOfStringsGrammar:
+    """
+    A JSON list of strings, e.g., ["Wie?", "Wat?"], with optional whitespace.
+
+    >>> grammar = JsonListOfStringsGrammar()
+    >>> grammar.is_complete(grammar.advance(grammar.initial(), ' ["Wie \\\\"ben\\\\" je?", "Wat?"]'))
+    True
+    >>> grammar.advance(grammar.initial(), '["Wie?" "Wat?"]') is None
+    True
+    >>> grammar.is_complete(grammar.advance(grammar.initial(), '["Wie?", '))
+    False
+    """
+
+    name = 'json_list_of_strings'
+
+    def initial(self):
+        return 'start'
+
+    def advance(self, state, text):
+        for char in text:
+            if state is None:
+                return None
+            state = self.advance_char(state, char)
+        return state
+
+    @staticmethod
+    def advance_char(state, char):
+        if state == 'in_string':
+            return 'escape' if char == '\\' else 'after_string' if char == '"' else None if char in '\n\r' else 'in_string'
+        if state == 'escape':
+            return 'in_string' if char in '"\\/bfnrtu' else None    # (not checking the hex digits after \u)
+        if char.isspace():
+            return state
+        return {
+            ('start', '['): 'after_open',
+            ('after_open', '"'): 'in_string',
+            ('after_open', ']'): 'done',
+            ('after_string', ','): 'after_comma',
+            ('after_string', ']'): 'done',
+            ('after_comma', '"'): 'in_string',
+        }.get((state, char))
+
+    def is_complete(self, state):
+        return state == 'done'
+
+
+class SubstringAutomaton:
+    """
+    Suffix automaton of a text: accepts exactly the substrings of the text, in time linear in their length.
+
+    >>> automaton = SubstringAutomaton('de grote grijze vos')
+    >>> automaton.advance(0, 'grijze') is not None, automaton.advance(0, 'grote vos') is not None
+    (True, False)
+    """
+
+    def __init__(self, text):
+        self.transitions = [{}]
+        links = [-1]
+        lengths = [0]
+        last = 0
+        for char in text:
+            current = len(self.transitions)
+            self.transitions.append({})
+            lengths.append(lengths[last] + 1)
+            links.append(0)
+            state = last
+            while state != -1 and char not in self.transitions[state]:
+                self.transitions[state][char] = current
+                state = links[state]
+            if state != -1:
+                next_state = self.transitions[state][char]
+                if lengths[state] + 1 == lengths[next_state]:
+                    links[current] = next_state
+                else:
+                    clone = len(self.transitions)
+                    self.transitions.append(dict(self.transitions[next_state]))
+                    lengths.append(lengths[state] + 1)
+                    links.append(links[next_state])
+                    while state != -1 and self.transitions[state].get(char) == next_state:
+                        self.transitions[state][char] = clone
+                        state = links[state]
+                    links[next_state] = links[current] = clone
+            last = current
+
+    def advance(self, state, text):
+        for char in text:
+            if (state := self.transitions[state].get(char)) is None:
+                return None
+        return state
+
+
+class QuoteGrammar:
+    """
+    A quote from the original text, as parse_string_quote_as_spans expects: one or more chunks separated by '...',
+    each (stripped, case-insensitively) a substring of the original. As in dotted_quote_to_regex, a chunk may end
+    in a question mark that the original lacks.
+
+    A state is a set of alternatives (automaton state, number of dots that may yet turn out to be a separator,
+    whether the chunk was closed by a character not in the original, like an extra '?'), since '.' can be part of a chunk or of a separator.
+
+    >>> grammar = QuoteGrammar('Sinds wanneer geldt deze maatregel (art. 2) en wat was destijds de motivatie')
+    >>> grammar.is_complete(grammar.advance(grammar.initial(), 'Sinds wanneer ... wat was destijds de motivatie?'))
+    True
+    >>> grammar.is_complete(grammar.advance(grammar.initial(), 'deze maatregel (art. 2)'))
+    True
+    >>> grammar.advance(grammar.initial(), 'Sinds wanneer geldt die maatregel') is None
+    True
+    """
+
+    name = 'quote'
+
+    def __init__(self, original):
+        self.automaton = SubstringAutomaton(original.lower())
+
+    def initial(self):
+        return frozenset({(0, 0, False)})
+
+    def advance(self, state, text):
+        for char in text.lower():
+            if not state:
+                return None
+            state = frozenset(alternative for old in state for alternative in self.advance_char(*old, char))
+        return state or None
+
+    def advance_char(self, automaton_state, n_dots, closed, char):
+        if char == '.':
+            if n_dots == 2:
+                yield 0, 0, False   # separator complete, start of a new chunk
+            elif automaton_state != 0 or n_dots:
+                yield automaton_state, n_dots + 1, closed
+            if not closed and (literal := self.automaton.advance(automaton_state, '.' * (n_dots + 1))) is not None:
+                yield literal, 0, False
+        elif closed:
+            if char.isspace() and n_dots == 0:
+                yield automaton_state, 0, True
+        elif automaton_state == 0 and n_dots == 0 and char.isspace():
+            yield automaton_state, 0, False   # chunks are stripped
+        elif (next_state := self.automaton.advance(automaton_state, '.' * n_dots + char)) is not None:
+            yield next_state, 0, False
+        elif char == '?' and automaton_state != 0 and n_dots == 0:
+            yield automaton_state, 0, True
+        elif char.isspace() and automaton_state != 0 and n_dots == 0:
+            yield automaton_state, 0, True    # e.g., space before ' ...', not itself in the original
+
+    def is_complete(self, state):
+        return bool(state) and any(automaton_state != 0 and n_dots == 0 for automaton_state, n_dots, closed in state)
+
+
+class JsonListStop:
+    """
+    Complete at the end of the first (bracket-balanced) JSON list of strings, e.g., after a preface.
+
+    >>> stop = JsonListStop()
+    >>> reply = 'Here is the answer [JSON]:\\n["Wie?", "Wat [sic] \\\\"doe\\\\" je?"]\\nHope this helps!'
+    >>> reply[:stop.end(reply)]
+    'Here is the answer [JSON]:\\n["Wie?", "Wat [sic] \\\\"doe\\\\" je?"]'
+    >>> stop.end('["Wie?", "Wat') is None
+    True
+    """
+
+    name = 'json_list'
+
+    def end(self, text):
+        depth = 0
+        start = None
+        in_string = escaped = False
+        for i, char in enumerate(text):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"' and depth:     # (outside a list, quotes are just prose)
+                in_string = True
+            elif char == '[':
+                if not depth:
+                    start = i
+                depth += 1
+            elif char == ']' and depth:
+                depth -= 1
+                if not depth:
+                    try:
+                        parse_json_list_of_strings(text[start:i + 1])
+                    except ValueError:
+                        continue
+                    return i + 1
+        return None
+
+
+class LineStop:
+    """
+    Complete at the end of the first non-empty line.
+
+    >>> LineStop().end('\\nSinds wanneer ... de motivatie?\\n\\nThis quote contains...')
+    32
+    """
+
+    name = 'line'
+
+    def end(self, text):
+        match = re.search(r'\S.*\n', text)
+        return match.end() - 1 if match else None
+
+
+def cut_at_stop(text, stop):
+    """
+    The reply up to where the stop condition says it's complete (the last token may have gone beyond it).
+    """
+    if stop is None or (end := stop.end(text)) is None:
+        return text
+    return text[:end]
+
+
+class GrammarLogitsProcessor:
+    """
+    Logits processor (for transformers' generate) that masks every token that would take a row's generated text
+    outside the grammar, and allows end-of-sequence only once the text is complete.
+
+    Only the top_k most likely tokens are checked first; the rest of the vocabulary only if none of those fit.
+    """
+
+    def __init__(self, tokenizer, grammar, eos_token_ids, top_k=32):
+        self.tokenizer = tokenizer
+        self.grammar = grammar
+        self.name = grammar.name
+        self.eos_token_ids = set(eos_token_ids)
+        self.top_k = top_k
+        self.prompt_length = None
+        self.states = {}
+        self.token_strings = {}
+
+    def token_string(self, token_id):
+        if token_id not in self.token_strings:
+            self.token_strings[token_id] = self.tokenizer.decode([token_id])
+        return self.token_strings[token_id]
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+
+        mask = scores.new_full(scores.shape, float('-inf'))
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            state = self.row_state(row, generated)
+            if state is None:     # shouldn't happen, but then don't constrain any further
+                mask[row] = 0
+                continue
+            allowed = self.allowed_tokens(state, scores[row].topk(self.top_k).indices.tolist())
+            if not allowed:
+                allowed = self.allowed_tokens(state, scores[row].argsort(descending=True).tolist(), stop_after=1)
+            if not allowed:
+                logging.warning('Constrained decoding got stuck; leaving the remainder unconstrained.')
+                allowed = list(range(scores.shape[1]))
+            mask[row, allowed] = 0
+
+        return scores + mask
+
+    def row_state(self, row, generated):
+        """
+        Advance the row's state by its last generated token, or recompute it if rows got out of sync.
+        """
+        n_generated, state = self.states.get(row, (0, self.grammar.initial()))
+        if n_generated == len(generated) - 1:
+            state = self.grammar.advance(state, self.token_string(generated[-1])) if state is not None else None
+        elif n_generated != len(generated):
+            state = self.grammar.advance(self.grammar.initial(), self.tokenizer.decode(generated))
+        self.states[row] = (len(generated), state)
+        return state
+
+    def allowed_tokens(self, state, candidates, stop_after=None):
+        allowed = []
+        for token_id in candidates:
+            if token_id in self.eos_token_ids:
+                ok = self.grammar.is_complete(state)
+            else:
+                token_string = self.token_string(token_id)
+                ok = token_string and '�' not in token_string and self.grammar.advance(state, token_string) is not None
+            if ok:
+                allowed.append(token_id)
+                if stop_after and len(allowed) >= stop_after:
+                    break
+        return allowed
+
+
+class StopWhenComplete:
+    """
+    Stopping criterion (for transformers' generate) that is true for each row whose generated text is complete
+    according to the stop condition.
+    """
+
+    def __init__(self, tokenizer, stop):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.prompt_length = None
+        self.last_shape = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # first called after one token was generated; (a pipeline may call generate again, for the next batch)
+        if self.last_shape != (input_ids.shape[0], input_ids.shape[1] - 1):
+            self.prompt_length = input_ids.shape[1] - 1
+        self.last_shape = tuple(input_ids.shape)
+        done = [self.stop.end(self.tokenizer.decode(row[self.prompt_length:], skip_special_tokens=True)) is not None
+                for row in input_ids.tolist()]
+        return input_ids.new_tensor(done).bool()
+
+
+def make_logits_processor(generator, grammar):
+    eos_token_ids = generator.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
+    return GrammarLogitsProcessor(generator.tokenizer, grammar, eos_token_ids + [generator.tokenizer.eos_token_id])
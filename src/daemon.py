@@ -0,0 +1,334 @@
+"""
+A daemon that keeps the model loaded and handles qsep and qspan jobs over a Unix socket, started with:
+
+    qsep serve --model ... [--batch-size 16]
+
+qsep and qspan then act as thin clients whenever a daemon for the same model is listening (unless --local).
+
+Protocol: newline-delimited JSON, one request per line, each with an 'id' that the response repeats:
+
+    {"id": 0, "task": "qsep", "line": "...", "options": {...}}              -> {"id": 0, "result": [...] or null}
+    {"id": 1, "task": "qspan", "original": "...", "rephrased": "...", "options": {...}}
+    {"id": 2, "task": "info"}                                 -> {"id": 2, "result": {"model": ..., "examples": {...}}}
+
+qsep jobs with validate in their options give validated splits; temp and topp in the options override the daemon's
+generation settings. The few-shot examples are the daemon's own (reported by info), so clients whose example options
+differ run locally instead. Responses can arrive out of order. Jobs from all
+connected clients that are waiting while the model is busy are processed together, in batches, grouped by options.
+"""
+
+import os
+import sys
+import json
+import stat
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+
+QSEP_OPTIONS = ('splitandmerge', 'validate', 'fuzzy', 'retry', 'validate_retry', 'candidates', 'aggregate', 'constrained', 'matcher', 'align', 'temp', 'topp')
+QSPAN_OPTIONS = ('fuzzy', 'retry', 'candidates', 'constrained', 'matcher', 'align', 'temp', 'topp')
+# Client options that only the daemon's own command line decides, with their defaults:
+DAEMON_OPTIONS = {'batch_size': 1, 'stream': False, 'cache_dir': None, 'prefix_cache': False}
+
+
+class DaemonError(Exception):
+    pass
+
+
+def default_socket_path():
+    """
+    In $XDG_RUNTIME_DIR, or else in a private directory in the temp dir (made if needed), so that other users cannot
+    put a socket of their own in its place. Raises DaemonError if that directory is not private (anymore).
+
+    >>> tempfile.tempdir, runtime_dir = tempfile.mkdtemp(), os.environ.pop('XDG_RUNTIME_DIR', None)
+    >>> socket_path = default_socket_path()
+    >>> oct(os.stat(os.path.dirname(socket_path)).st_mode & 0o777)
+    '0o700'
+    >>> os.chmod(os.path.dirname(socket_path), 0o777)
+    >>> default_socket_path()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    daemon.DaemonError: .../qsep-... is not a private directory of this user; remove it, or give --socket.
+    >>> tempfile.tempdir = None
+    >>> if runtime_dir is not None: os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+    """
+    if runtime_dir := os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(runtime_dir, f'qsep-{os.getuid()}.sock')
+    directory = os.path.join(tempfile.gettempdir(), f'qsep-{os.getuid()}')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise DaemonError(f'{directory} is not a private directory of this user; remove it, or give --socket.')
+    return os.path.join(directory, 'qsep.sock')
+
+
+class Daemon:
+
+    def __init__(self, pipe, model_name, batch_size=1, examples=None):
+        self.pipe = pipe
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.examples = examples or {}
+        self.jobs = None
+
+    async def serve(self, socket_path):
+        self.jobs = asyncio.Queue()
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path, limit=2 ** 24)
+        logging.info('Listening on %s', socket_path)
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.process_jobs())
+        finally:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+    async def handle_client(self, reader, writer):
+        responses = []
+        while line := await reader.readline():
+            request = json.loads(line)
+            if request['task'] == 'info':
+                self.respond(writer, request['id'], {'model': self.model_name, 'examples': self.examples})
+                continue
+            future = asyncio.get_running_loop().create_future()
+            await self.jobs.put((request, future))
+            responses.append(asyncio.create_task(self.respond_when_done(writer, request['id'], future)))
+        await asyncio.gather(*responses)
+        writer.close()
+
+    async def respond_when_done(self, writer, request_id, future):
+        try:
+            self.respond(writer, request_id, await future)
+        except Exception as e:
+            writer.write((json.dumps({'id': request_id, 'error': repr(e)}) + '\n').encode())
+        await writer.drain()
+
+    @staticmethod
+    def respond(writer, request_id, result):
+        writer.write((json.dumps({'id': request_id, 'result': result}) + '\n').encode())
+
+    async def process_jobs(self):
+        """
+        Take all jobs waiting at that moment (from whichever client), and run them in groups of the same task and
+        options, in a thread so the daemon keeps accepting jobs meanwhile.
+        """
+        while True:
+            jobs = [await self.jobs.get()]
+            while not self.jobs.empty():
+                jobs.append(self.jobs.get_nowait())
+
+            groups = collections.defaultdict(list)
+            for request, future in jobs:
+                groups[request['task'], json.dumps(request.get('options', {}), sort_keys=True)].append((request, future))
+
+            for (task, options), group in groups.items():
+                logging.info('Running %d %s jobs together.', len(group), task)
+                try:
+                    results = await asyncio.to_thread(self.run_jobs, task, json.loads(options), [request for request, future in group])
+                except Exception as e:
+                    logging.exception(f'Failed running {task} jobs')
+                    for request, future in group:
+                        future.set_exception(e)
+                else:
+                    for (request, future), result in zip(group, results):
+                        future.set_result(result)
+
+    def run_jobs(self, task, options, requests):
+        import qsep
+        import qspan
+        from backends import WithSettings
+
+        overrides = {setting: options[option] for option, setting in (('temp', 'temperature'), ('topp', 'top_p')) if option in options}
+        pipe = WithSettings(self.pipe, **overrides)
+
+        if task == 'qsep':
+            return qsep.separate_questions(list(enumerate(request['line'] for request in requests)), pipe, n_retries=options['retry'],
+                                           batch_size=self.batch_size, splitandmerge=options['splitandmerge'], validate=options['validate'],
+                                           validate_n_retries=options['validate_retry'], fuzzy=options['fuzzy'], n_candidates=options['candidates'],
+                                           aggregate=options['aggregate'], constrained=options['constrained'], matcher=options['matcher'],
+                                           align_threshold=options['align'])
+        if task == 'qspan':
+            return qspan.find_supporting_quote_batch([(request['original'], request['rephrased']) for request in requests], pipe,
+                                                     n_retries=options['retry'], batch_size=self.batch_size, fuzzy=options['fuzzy'],
+                                                     n_candidates=options['candidates'], constrained=options['constrained'],
+                                                     matcher=options['matcher'], align_threshold=options['align'])
+        raise ValueError(f'Unknown task {task}')
+
+
+def daemon_info(socket_path):
+    """
+    The daemon's info (e.g., its model), or None if no daemon is listening on the socket.
+    """
+    try:
+        responses = request_daemon(socket_path, [{'task': 'info'}])
+        info = next(responses)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except DaemonError as e:
+        logging.warning(e)
+        return None
+    responses.close()
+    return info
+
+
+def request_daemon(socket_path, requests):
+    """
+    Send the requests (an iterable of dicts, without 'id') to the daemon, yielding their results in order; None
+    for jobs that failed in the daemon. Requests are sent from a separate thread, so they can be read lazily; an
+    exception there (e.g., from reading the requests) is raised here, once the daemon has answered what was sent.
+    Raises DaemonError if the socket belongs to another user (who could read the requests and forge results), or if
+    the connection ends with requests unanswered (e.g., because the daemon died).
+
+    >>> import itertools
+    >>> socket_path = os.path.join(tempfile.mkdtemp(), 'test.sock')
+    >>> server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    >>> server.bind(socket_path)
+    >>> server.listen()
+    >>> def answer(n_answers):     # a daemon that dies after answering n_answers requests
+    ...     connection, _ = server.accept()
+    ...     with connection, connection.makefile('r') as requests:
+    ...         for request in itertools.islice(requests, n_answers):
+    ...             connection.sendall((json.dumps({'id': json.loads(request)['id'], 'result': 'ok'}) + '\\n').encode())
+    >>> _ = threading.Thread(target=answer, args=(2,)).start()
+    >>> list(request_daemon(socket_path, [{'task': 'qsep'}] * 4))
+    Traceback (most recent call last):
+    daemon.DaemonError: Connection to the daemon ended without answers for inputs 2, 3.
+    >>> def bad_requests():
+    ...     yield {'task': 'qsep'}
+    ...     raise ValueError('Malformed input')
+    >>> _ = threading.Thread(target=answer, args=(2,)).start()
+    >>> list(request_daemon(socket_path, bad_requests()))
+    Traceback (most recent call last):
+    ValueError: Malformed input
+    """
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise DaemonError(f'{socket_path} belongs to another user; not sending it any inputs.')
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    n_requests = 0
+    failed = []
+
+    def send():
+        nonlocal n_requests
+        connected = True
+        try:
+            for request_id, request in enumerate(requests):
+                n_requests = request_id + 1
+                if connected:
+                    try:
+                        connection.sendall((json.dumps({**request, 'id': request_id}) + '\n').encode())
+                    except OSError:
+                        connected = False   # the daemon is gone; only count the rest, to report them below
+        except Exception as e:
+            failed.append(e)
+        finally:
+            try:
+                connection.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    waiting = {}
+    next_id = 0
+    with connection, connection.makefile('r', encoding='utf-8') as responses:
+        try:
+            for response in responses:
+                response = json.loads(response)
+                if 'error' in response:
+                    logging.warning(f'Daemon failed request {response["id"]}: {response["error"]}')
+                waiting[response['id']] = response.get('result')
+                while next_id in waiting:
+                    yield waiting.pop(next_id)
+                    next_id += 1
+        except ConnectionError:
+            pass
+    sender.join()
+    if failed:
+        raise failed[0]
+    if unanswered := [request_id for request_id in range(next_id, n_requests) if request_id not in waiting]:
+        raise DaemonError(f'Connection to the daemon ended without answers for inputs {", ".join(map(str, unanswered))}.')
+
+
+def example_options(examples=None, quote_examples=None, n_examples=None):
+    """
+    As the daemon reports them in its info, for comparing with a client's (with absolute paths, as its working
+    directory may differ).
+    """
+    return {'examples': examples and os.path.abspath(examples), 'quote_examples': quote_examples and os.path.abspath(quote_examples),
+            'n_examples': n_examples}
+
+
+def find_daemon(args, examples):
+    """
+    Socket path of a daemon serving args.model with the same examples (those of example_options that the client
+    uses), if any (and if not args.local). Warns about the client's options that the daemon ignores.
+    """
+    if args.local:
+        return None
+    try:
+        args.socket = args.socket or default_socket_path()
+    except DaemonError as e:
+        logging.warning(f'{e} Running locally.')
+        return None
+    if (info := daemon_info(args.socket)) is None:
+        return None
+    if info['model'] != args.model:
+        logging.warning(f'Daemon on {args.socket} serves {info["model"]}, not {args.model}; running locally.')
+        return None
+    daemon_examples = info.get('examples', example_options())
+    if any(daemon_examples.get(key) != value for key, value in examples.items()):
+        logging.warning(f'Daemon on {args.socket} uses other few-shot examples ({info.get("examples")}); running locally.')
+        return None
+    if ignored := [option for option, default in DAEMON_OPTIONS.items() if getattr(args, option, default) not in (default, None)]:
+        logging.warning('Ignoring %s, as the daemon decides these (see qsep serve --help).', ', '.join('--' + option.replace('_', '-') for option in ignored))
+    logging.info('Sending jobs to daemon on %s.', args.socket)
+    return args.socket
+
+
+def serve_main(argv=None):
+    from backends import make_backend
+    from response_cache import ResponseCache, CachedPipe
+
+    logging.basicConfig(level=logging.INFO)
+
+    argparser = argparse.ArgumentParser(prog='qsep serve', description='Keep the model loaded and handle qsep/qspan jobs sent over a Unix socket.')
+    argparser.add_argument('--socket', required=False, type=str, help='Path of the Unix socket to listen on; default in $XDG_RUNTIME_DIR, or in a private directory in the temp dir.', default=None)
+    argparser.add_argument('--model', nargs='?', default="unsloth/llama-3-70b-Instruct-bnb-4bit", type=str, help='Model name; "test" for a fast, deterministic fake model (see backends.FakeBackend).')
+    argparser.add_argument('--temp', required=False, type=float, help='Temperature', default=.1)
+    argparser.add_argument('--topp', required=False, type=float, help='Sample only from top probability', default=None)
+    argparser.add_argument('--batch-size', required=False, type=int, help='Number of inputs (from any client) to send through the LLM at once.', default=8)
+    argparser.add_argument('--server', required=False, type=str, help='URL of an OpenAI-compatible server to send requests to, instead of loading --model in-process.', default=None)
+    argparser.add_argument('--max-in-flight', required=False, type=int, help='With --server, max number of concurrent requests.', default=32)
+    argparser.add_argument('--cache-dir', required=False, type=str, help='Directory for a persistent cache of LLM responses.', default=None)
+    argparser.add_argument('--cache-size', required=False, type=float, help='Max size of the response cache (in MB).', default=1000)
+    argparser.add_argument('--examples', required=False, type=str, help='File with few-shot examples for splitting (see qsep --examples).', default=None)
+    argparser.add_argument('--quote-examples', required=False, type=str, help='File with few-shot examples for quoting (see qspan --examples).', default=None)
+    argparser.add_argument('--n-examples', required=False, type=int, help='Put only this many examples, those most similar to the input, in each prompt.', default=None)
+    args = argparser.parse_args(argv)
+
+    try:
+        args.socket = args.socket or default_socket_path()
+    except DaemonError as e:
+        sys.exit(str(e))
+    if daemon_info(args.socket) is not None:
+        sys.exit(f'A daemon is already listening on {args.socket}.')
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)  # left behind by a daemon that was killed
+
+    pipe = make_backend(args.model, server=args.server, max_in_flight=args.max_in_flight, max_new_tokens=1000, temperature=args.temp, top_p=args.topp)
+    if args.cache_dir:
+        pipe = CachedPipe(pipe, ResponseCache(args.cache_dir, max_size=args.cache_size * 1e6), model_name=args.model)
+
+    import qsep
+    qsep.set_examples(args)
+    examples = example_options(args.examples, args.quote_examples, args.n_examples)
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())   # (so the socket gets removed)
+    try:
+        asyncio.run(Daemon(pipe, args.model, batch_size=args.batch_size, examples=examples).serve(args.socket))
+    except KeyboardInterrupt:
+        pass
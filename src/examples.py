@@ -0,0 +1,74 @@
+"""
+Few-shot example libraries: a pool of examples (e.g., loaded from a file), indexed once as character n-gram vectors
+in a NumPy matrix, from which only the k most similar to the input are put in each prompt. The pool can then grow
+while the prompts (and their prefill) stay short.
+
+>>> library = ExampleLibrary([{'prompt': 'Sinds wanneer geldt deze maatregel?', 'response': '...'},
+...                           {'prompt': 'Wie heeft de brief gelezen, en wanneer?', 'response': '...'},
+...                           {'prompt': 'Hoevaak nemen mensen de fiets?', 'response': '...'}], k=2)
+>>> [example['prompt'] for example in library.select('Heeft u de brief gelezen? En wat is uw reactie?')]
+['Sinds wanneer geldt deze maatregel?', 'Wie heeft de brief gelezen, en wanneer?']
+"""
+
+import json
+
+
+class ExampleLibrary:
+    """
+    Examples are dicts with at least 'prompt' and 'response'; similarity to the input is computed on their key field
+    (by cosine of tf-idf weighted character n-grams). With k None, all examples are selected, as without a library.
+    Selected examples keep their order in the library, so that inputs with the same selection share a prompt prefix.
+    """
+
+    def __init__(self, examples, key='prompt', k=None, n=3):
+        self.examples = examples
+        self.key = key
+        self.k = k
+        self.n = n
+        self.vocabulary = None
+        self.idf = None
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.examples)
+
+    def ngrams(self, text):
+        text = ' ' + ' '.join(text.lower().split()) + ' '
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def index(self):
+        import numpy
+
+        ngrams_per_example = [self.ngrams(example[self.key]) for example in self.examples]
+        self.vocabulary = {}
+        for ngrams in ngrams_per_example:
+            for ngram in ngrams:
+                self.vocabulary.setdefault(ngram, len(self.vocabulary))
+        self.matrix = numpy.zeros((len(self.examples), len(self.vocabulary)), dtype=numpy.float32)
+        for row, ngrams in enumerate(ngrams_per_example):
+            self.matrix[row, [self.vocabulary[ngram] for ngram in ngrams]] = 1
+        self.idf = numpy.log(len(self.examples) / self.matrix.sum(axis=0)) + 1
+        self.matrix *= self.idf
+        self.matrix /= numpy.linalg.norm(self.matrix, axis=1, keepdims=True)
+
+    def select(self, text):
+        if self.k is None or self.k >= len(self.examples):
+            return self.examples
+        import numpy
+
+        if self.matrix is None:
+            self.index()
+        vector = numpy.zeros(len(self.vocabulary), dtype=numpy.float32)
+        vector[[self.vocabulary[ngram] for ngram in self.ngrams(text) if ngram in self.vocabulary]] = 1
+        # (no need to normalize the input's vector, for ranking)
+        similarities = self.matrix @ (vector * self.idf)
+        top = numpy.argsort(-similarities, kind='stable')[:self.k]
+        return [self.examples[i] for i in sorted(top)]
+
+
+def load_examples(path) -> list[dict]:
+    """
+    Examples from a file with one JSON object per line, with the same fields as the tool's built-in EXAMPLES.
+    """
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
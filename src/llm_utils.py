@@ -1,35 +1,42 @@
 import json
 import logging
-import functools
+import collections
+import copy
 
+from metrics import METRICS, OneLine
 
-def retry_until_parse(pipe, chat_start, parser, n_retries, fail_ok=False, try_skip_first_line=True, increase_temp=.1):
+
+def retry_until_parse(pipe, chat_start, parser, n_retries, fail_ok=False, try_skip_first_line=True, increase_temp=.1, n_candidates=1, aggregate='first', grammar=None, stop=None, max_new_tokens=None):
     """
     :param try_skip_first_line: Sometimes LLMs preface their (otherwise fine) answer by "Here is the answer:" etc.
+    :param n_candidates: Number of responses to sample per attempt, in a single generate call (sharing the prompt).
+    :param aggregate: How to choose among the candidates that parsed; see AGGREGATORS.
+    :param grammar: To constrain decoding to outputs the parser will (likely) accept; see constraints.py.
+    :param stop: To stop generating once the output is complete (and cut it off there); see constraints.py.
+    :param max_new_tokens: Overrides the pipe's, e.g., as computed by token_budget.
     """
     n_try = 0
     result = None
     errors = []
-    logging.info(f'Prompt: {chat_start[-1]["content"]}'.replace('\n', '//'))
+    temperature = pipe.settings['temperature']
+    logging.info('Prompt: %s', OneLine(chat_start[-1]['content']))
     while result is None and n_try < n_retries:
         n_try += 1
-        raw = pipe([chat_start])[0][0]['generated_text'][-1]['content']
-        logging.info(f'(Attempt {n_try}): Model says: {raw}'.replace('\n', '//'))
-        pipe = functools.partial(pipe, temperature=pipe.keywords['temperature'] + increase_temp)
+        raws = generate_candidates(pipe, [chat_start], n_candidates, grammar=grammar, stop=stop, temperature=temperature,
+                                   max_new_tokens=max_new_tokens or pipe.settings.get('max_new_tokens'))[0]
+        for raw in raws:
+            logging.info('(Attempt %d): Model says: %s', n_try, OneLine(raw))
+        temperature += increase_temp
         try:
-            result = parser(raw)
-        except ValueError as e1:    # TODO: refactor
-            if try_skip_first_line and (raw_lines := raw.splitlines()) and len(raw_lines) > 1:
-                try:
-                    result = parser('\n'.join(raw_lines[1:]))
-                except ValueError as e2:
-                    errors.append(str(e1) + '; ' + str(e2))
-                    continue
-            else:
-                errors.append(str(e1))
-                continue
+            result = parse_candidates(raws, parser, try_skip_first_line, aggregate)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        METRICS.count('attempts', n_try)
         return result
     else:
+        METRICS.count('attempts', n_try)
+        METRICS.count('failures')
         if not fail_ok:
             raise ValueError(f'Max number of retries ({"; ".join(errors)})')
         else:
@@ -37,6 +44,236 @@ def retry_until_parse(pipe, chat_start, parser, n_retries, fail_ok=False, try_sk
             return None
 
 
+def retry_until_parse_batch(pipe, chat_starts, parser, n_retries, batch_size, try_skip_first_line=True, increase_temp=.1, n_candidates=1, aggregate='first', grammar=None, stop=None, max_new_tokens=None):
+    """
+    Like retry_until_parse, but for many chats at once. Chats of similar length are sent through the pipe together
+    (to reduce padding), and chats whose response failed to parse go into a next batch for another try, at a
+    higher temperature (along with only other chats at the same attempt).
+
+    The parser, and max_new_tokens, can also be a list, with one per chat (a batch gets the max_new_tokens of its
+    most demanding chat).
+
+    Returns results in the order of chat_starts, with None for chats that failed to parse after n_retries.
+    """
+    base_temp = pipe.settings['temperature']
+    results = [None] * len(chat_starts)
+    errors = [[] for _ in chat_starts]
+    n_tries = [0] * len(chat_starts)
+
+    # all chats share the system prompt and examples, so the final user turn determines the length:
+    waiting = {0: sorted(range(len(chat_starts)), key=lambda i: len(chat_starts[i][-1]['content']))} if chat_starts else {}
+
+    while waiting:
+        # retries first; each batch has chats at the same attempt, hence temperature, so that a chat's replies
+        # don't depend on which others it happens to be batched with:
+        n_tried = max(waiting)
+        batch, waiting[n_tried] = waiting[n_tried][:batch_size], waiting[n_tried][batch_size:]
+        if not waiting[n_tried]:
+            del waiting[n_tried]
+
+        temperature = base_temp + increase_temp * n_tried
+        batch_max_new_tokens = max(max_new_tokens[i] for i in batch) if isinstance(max_new_tokens, list) else max_new_tokens
+        all_raws = generate_candidates(pipe, [chat_starts[i] for i in batch], n_candidates, batch_size=batch_size, grammar=grammar, stop=stop,
+                                       temperature=temperature, max_new_tokens=batch_max_new_tokens or pipe.settings.get('max_new_tokens'))
+
+        for i, raws in zip(batch, all_raws):
+            n_tries[i] += 1
+            for raw in raws:
+                logging.info('(Item %d, attempt %d): Model says: %s', i, n_tries[i], OneLine(raw))
+            try:
+                results[i] = parse_candidates(raws, parser[i] if isinstance(parser, list) else parser, try_skip_first_line, aggregate)
+            except ValueError as e:
+                errors[i].append(str(e))
+                if n_tries[i] < n_retries:
+                    waiting.setdefault(n_tries[i], []).append(i)
+                else:
+                    logging.warning(f'Max number of retries for item {i} ({"; ".join(errors[i])})')
+
+    METRICS.count('attempts', sum(n_tries))
+    METRICS.count('failures', results.count(None))
+    return results
+
+
+def aggregate_most(results):
+    return max(results, key=len)
+
+
+def aggregate_vote(results):
+    votes = collections.Counter(json.dumps(result) for result in results)
+    winner = max(votes, key=votes.get)
+    return next(result for result in results if json.dumps(result) == winner)
+
+
+AGGREGATORS = {
+    'first': lambda results: results[0],
+    'most': aggregate_most,     # e.g., the candidate listing the most subquestions
+    'vote': aggregate_vote,     # the most frequent candidate (ties: the earliest)
+}
+
+
+def parse_candidates(raws, parser, try_skip_first_line=True, aggregate='first'):
+    """
+    Parse multiple candidate responses, in order, aggregating those that parse. Raises ValueError if none do.
+
+    For 'first', parsing stops at the first candidate that parses (relevant for parsers with side effects).
+
+    >>> parse_candidates(['no', '[1, 2]', '[3]', '[3]'], json.loads, aggregate='first')
+    [1, 2]
+    >>> parse_candidates(['[3]', '[1, 2]', '[3]'], json.loads, aggregate='most')
+    [1, 2]
+    >>> parse_candidates(['[1, 2]', '[3]', 'no', '[3]'], json.loads, aggregate='vote')
+    [3]
+    """
+    results = []
+    errors = []
+    for raw in raws:
+        try:
+            results.append(parse_maybe_skipping_first_line(raw, parser, try_skip_first_line))
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        if aggregate == 'first':
+            break
+
+    if not results:
+        raise ValueError('; '.join(errors))
+    return AGGREGATORS[aggregate](results)
+
+
+def parse_maybe_skipping_first_line(raw, parser, try_skip_first_line=True):
+    try:
+        return parser(raw)
+    except ValueError as e1:
+        if try_skip_first_line and (raw_lines := raw.splitlines()) and len(raw_lines) > 1:
+            try:
+                return parser('\n'.join(raw_lines[1:]))
+            except ValueError as e2:
+                raise ValueError(str(e1) + '; ' + str(e2))
+        raise
+
+
+def generate(pipe, chats, batch_size=None, **kwargs):
+    """
+    Send a list of chats through the text-generation pipe, returning only the model's reply to each.
+    """
+    return [raws[0] for raws in generate_candidates(pipe, chats, 1, batch_size=batch_size, **kwargs)]
+
+
+def generate_candidates(pipe, chats, n_candidates, batch_size=None, grammar=None, stop=None, **kwargs):
+    """
+    Like generate, but sampling n_candidates replies per chat (sharing the prefill of the prompt, where possible).
+    If a grammar is given (see constraints.py), decoding is constrained to it; if a stop condition is given,
+    generation stops once it's met. Keyword arguments override the pipe's generation settings (see backends.py).
+    """
+    with METRICS.stage('generate', n_chats=len(chats)):
+        METRICS.count('chats', len(chats))
+        return pipe.generate(chats, n_candidates, batch_size=batch_size, grammar=grammar, stop=stop, **kwargs)
+
+
+def token_budget(pipe, text, per_token=1.0, extra=32):
+    """
+    A max_new_tokens for replies derived from text (e.g., a quote from it): per_token tokens per token of text,
+    plus extra, but no more than the pipe's own max_new_tokens.
+
+    >>> from backends import FakeBackend
+    >>> token_budget(FakeBackend(max_new_tokens=1000), 'Wie ben je? En wat doe je?', per_token=4)
+    60
+    """
+    budget = int(per_token * pipe.count_tokens(text)) + extra
+    if (max_new_tokens := pipe.settings.get('max_new_tokens')) is not None:
+        budget = min(budget, max_new_tokens)
+    return budget
+
+
+def prepare_for_batching(generator):
+    """
+    Batched generation requires padding, which (e.g.) Llama's tokenizer doesn't define; decoder-only models
+    furthermore need it on the left.
+    """
+    if generator.tokenizer.pad_token_id is None:
+        generator.tokenizer.pad_token_id = generator.tokenizer.eos_token_id
+    generator.tokenizer.padding_side = 'left'
+    return generator
+
+
+def chat_input_ids(tokenizer, chat):
+    """
+    The token ids that generation for the chat starts from (tokenizing the template's text, as what
+    apply_chat_template returns when tokenizing differs between transformers versions).
+    """
+    text = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text, add_special_tokens=False).input_ids
+
+
+PREFIX_CACHES = {}  # (model name, tool) -> PrefixCache
+
+
+class PrefixCache:
+    """
+    The tokenized fixed prefix of a tool's prompts (system prompt, examples, and the constant start of the final user
+    turn), along with its past_key_values, computed once so that generation needs to prefill only the remainder.
+
+    Only fits unbatched generation: with left-padding, the prefix would be at a different position in each row. So
+    once a prefix cache is registered, the pipeline backend generates chats that start with it one at a time.
+
+    Generation with the prefix cache gives the same replies as without; see test_prefix_cache.py.
+    """
+
+    SENTINEL = '<<<INPUT>>>'
+
+    def __init__(self, generator, examples, system_prompt, prompt_start=''):
+        import torch
+        from transformers import DynamicCache
+
+        chat = make_chat_start(prompt_start + self.SENTINEL, examples, system_prompt)
+        text = generator.tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
+        prefix_text = text[:text.index(self.SENTINEL)]
+        # Leave off the final token, as it may be merged differently with whatever input follows:
+        self.input_ids = generator.tokenizer(prefix_text, add_special_tokens=False).input_ids[:-1]
+        with torch.no_grad():
+            self.past_key_values = generator.model(torch.tensor([self.input_ids], device=generator.model.device),
+                                                   past_key_values=DynamicCache(), use_cache=True).past_key_values
+
+    def applies_to(self, tokenizer, chat):
+        return chat_input_ids(tokenizer, chat)[:len(self.input_ids)] == self.input_ids
+
+    def fresh_copy(self, n_copies=1):
+        """
+        Generation extends the cache in place, so each call needs its own copy (one per returned sequence).
+        """
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if n_copies > 1:
+            past_key_values.batch_repeat_interleave(n_copies)
+        return past_key_values
+
+
+def register_prefix_cache(pipe, tool, examples, system_prompt, prompt_start=''):
+    if (generator := getattr(unwrap_pipe(pipe), 'generator', None)) is None:
+        logging.warning('Prefix caching requires an in-process model; ignoring it (a server may do its own).')
+        return None
+    key = (generator.model.name_or_path, tool)
+    if key not in PREFIX_CACHES:
+        PREFIX_CACHES[key] = PrefixCache(generator, examples, system_prompt, prompt_start)
+    return PREFIX_CACHES[key]
+
+
+def find_prefix_cache(pipe, chat):
+    generator = unwrap_pipe(pipe).generator
+    for (model_name, tool), prefix_cache in PREFIX_CACHES.items():
+        if model_name == generator.model.name_or_path and prefix_cache.applies_to(generator.tokenizer, chat):
+            return prefix_cache
+    return None
+
+
+def unwrap_pipe(pipe):
+    """
+    Get the underlying backend from a pipe that may be wrapped in a CachedPipe.
+    """
+    while hasattr(pipe, 'backend'):
+        pipe = pipe.backend
+    return pipe
+
+
 def make_chat_start(prompt, examples, system_prompt):
     examples_chat = []
     for example in examples:    # TODO This is executed anew for each prompt...
@@ -0,0 +1,138 @@
+"""
+Run-level instrumentation: time spent, calls and counts (tokens, attempts, failed validations, ...) per stage,
+where stages nest (e.g., 'validate/generate' is generation for validation). Disabled (and nearly free) unless
+enabled, as by --metrics, which writes the totals, and per-line averages, as JSON or as a Prometheus textfile.
+
+Optionally (--trace), each stage is also recorded as a tracing span, written in Chrome's trace event format
+(viewable in chrome://tracing or ui.perfetto.dev).
+
+>>> metrics = Metrics(enabled=True)
+>>> with metrics.stage('validate'):
+...     with metrics.stage('generate'):
+...         metrics.count('chats', 3)
+>>> metrics.count('lines')
+>>> metrics.totals['validate/generate']['chats'], metrics.totals['validate']['calls'], metrics.totals['']['lines']
+(3, 1, 1)
+>>> print(*[line for line in metrics.to_prometheus().splitlines() if 'seconds' not in line], sep='\\n')
+qsep_lines_total{stage=""} 1
+qsep_calls_total{stage="validate"} 1
+qsep_calls_total{stage="validate/generate"} 1
+qsep_chats_total{stage="validate/generate"} 3
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+
+
+class Metrics:
+
+    def __init__(self, enabled=False, tracing=False):
+        self.enabled = enabled
+        self.trace = [] if tracing else None
+        self.totals = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, **attributes):
+        if not self.enabled:
+            yield
+            return
+        stack = self.stack()
+        stack.append(name)
+        path = '/'.join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.totals[path]['seconds'] += seconds
+                self.totals[path]['calls'] += 1
+                if self.trace is not None:
+                    self.trace.append({'name': path, 'ph': 'X', 'ts': 1e6 * (start - self.start_time), 'dur': 1e6 * seconds,
+                                       'pid': os.getpid(), 'tid': threading.get_ident(), 'args': attributes})
+
+    def count(self, key, value=1):
+        """
+        Add to a count in the current stage (of the current thread).
+        """
+        if not self.enabled:
+            return
+        path = '/'.join(self.stack())
+        with self.lock:
+            self.totals[path][key] += value
+
+    def summary(self) -> dict:
+        n_lines = self.totals['']['lines'] if '' in self.totals else 0
+        stages = {path: dict(values) for path, values in sorted(self.totals.items())}
+        return {
+            'lines': n_lines,
+            'seconds': time.perf_counter() - self.start_time,
+            'stages': stages,
+            'per_line': {path: {key: value / n_lines for key, value in values.items()} for path, values in stages.items()} if n_lines else {},
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for path, values in sorted(self.totals.items()):
+            for key, value in sorted(values.items()):
+                lines.append(f'qsep_{key}_total{{stage="{path}"}} {value}')
+        return '\n'.join(lines)
+
+    def write(self, path=None, trace_path=None):
+        """
+        As a Prometheus textfile if path ends in .prom, otherwise as JSON; either path may be None.
+
+        >>> import tempfile
+        >>> metrics = Metrics(enabled=True, tracing=True)
+        >>> with metrics.stage('split', n_chats=2):
+        ...     pass
+        >>> trace_path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        >>> metrics.write(None, trace_path)
+        >>> with open(trace_path) as file:
+        ...     [(event['name'], event['args']) for event in json.load(file)['traceEvents']]
+        [('split', {'n_chats': 2})]
+        """
+        if path:
+            with open(path, 'w') as file:
+                if path.endswith('.prom'):
+                    file.write(self.to_prometheus() + '\n')
+                else:
+                    json.dump(self.summary(), file, indent=2)
+        if trace_path and self.trace is not None:
+            with open(trace_path, 'w') as file:
+                json.dump({'traceEvents': self.trace}, file)
+
+
+METRICS = Metrics()
+
+
+def enable(tracing=False):
+    METRICS.__init__(enabled=True, tracing=tracing)
+
+
+class OneLine:
+    """
+    For logging a text on a single line, only doing the work if the message is actually logged.
+
+    >>> str(OneLine('Here is the answer:\\n["Wie?"]'))
+    'Here is the answer://["Wie?"]'
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text.replace('\n', '//')
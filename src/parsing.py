@@ -0,0 +1,184 @@
+"""
+Parsing LLM responses and matching quotes to the original text, without any LLM, for qsep and qspan but also for
+post-processing their outputs: importing this module takes milliseconds (see benchmarks.py).
+"""
+
+import re
+import json
+import math
+import typing
+import functools
+
+import spanmatch
+from metrics import METRICS
+
+if typing.TYPE_CHECKING:
+    import regex
+
+
+def parse_json_or_itemized_list_of_strings(raw):
+    try:
+        return parse_json_list_of_strings(raw)
+    except ValueError as e1:
+        try:
+            return parse_itemized_list_of_strings(raw)
+        except ValueError as e2:
+            raise ValueError(f'{e1}; {e2}')
+
+
+def parse_json_list_of_strings(raw):
+    try:
+        result = json.loads(raw)
+    except json.JSONDecodeError:
+        raise ValueError('Not a json string')
+    if not isinstance(result, list):
+        raise ValueError('Not a list')
+    if any(not isinstance(x, str) for x in result):
+        raise ValueError('List contains a non-string')
+    return result
+
+
+enum_regex = re.compile(r'[ \t]*\d+. +([^\n]+)')
+item_regex = re.compile(r'[ \t]*- +([^\n]+)')
+
+def parse_itemized_list_of_strings(raw):
+    if len(result := enum_regex.findall(raw)) <= 1 and len(result := item_regex.findall(raw)) <= 1:
+        raise ValueError('Not an itemized/enumerated list of strings')
+    return [s.strip('"\'') for s in result]
+
+
+def iter_question_tuples(line: str, n_per_tuple: int):
+    """
+    >>> list(iter_question_tuples('Test? Hello? Not sure?', 1))
+    [(0, 0, 'Test?'), (5, 5, ' Hello?'), (12, 12, ' Not sure?')]
+    >>> list(iter_question_tuples('Test? Hello? Not sure?', 2))
+    [(0, 0, 'Test?'), (0, 5, 'Test? Hello?'), (5, 12, ' Hello? Not sure?')]
+    """
+
+    questions = [None] * (n_per_tuple - 1) + list(re.finditer(r'[^?]+\?', line))    # lookahead, but caused misses: (?=(?: +[A-Z])|(?: *$))
+    tuples = zip(*[questions[n:] for n in range(n_per_tuple)])
+    for questions_tuple in tuples:
+        questions_tuple = tuple(filter(None, questions_tuple))
+        chunk_start = questions_tuple[0].span()[0]
+        target_start = questions_tuple[-1].span()[0]
+        chunk_text = ''.join(match.group() for match in questions_tuple)
+
+        yield chunk_start, target_start, chunk_text
+
+
+def normalize_question(question):
+    """
+    >>> normalize_question(' Wat is  uw reactie? ') == normalize_question('wat is uw reactie')
+    True
+    """
+    return ' '.join(re.findall(r'\w+', question.lower()))
+
+
+# # Currently disabled because I don't think LLMs can count characters, and handling discontinuous spans not yet attempted.
+#
+# def parse_json_quote_as_spans(quote: str, original: str, fuzzy=0.0, already_used=None) -> list[dict]:
+#     try:
+#         d = json.loads(quote)
+#     except json.JSONDecodeError as e:
+#         raise ValueError(f"No valid JSON in {quote}")
+#
+#     if 'start' not in d or 'end' not in d or 'text' not in d:
+#         raise ValueError(f"Key missing in {quote}")
+#
+#     start, end, text = d['start'], d['end'], d['text']
+#     if not (0 <= start <= end <= len(original)):
+#         raise ValueError(f"No proper start/end indices in {quote}")
+#
+#     target = original[start:end]
+#     if target != text:
+#         raise ValueError(f"Start:end results in different string ({text} != {target}) for {quote}")
+#
+#     parse_string_quote_as_spans(text, original, fuzzy, already_used)
+#
+
+
+@METRICS.stage('match')
+def parse_string_quote_as_spans(quote: str, original: str, fuzzy=0.0, already_used=None, only_from_char=0, matcher='fast') -> list[dict]:
+    """
+    Matcher 'fast' (see spanmatch.py) tries an exact match first and allows only as many errors as needed;
+    'regex' uses dotted_quote_to_regex's fuzzy regular expression. For the fast matcher, already_used can be
+    a UsedSpans, for O(1) lookups.
+
+    >>> parse_string_quote_as_spans('de grote ... was lui', 'de grote grijze vos was lui')
+    [{'start': 0, 'end': 8, 'text': 'de grote'}, {'start': 20, 'end': 27, 'text': 'was lui'}]
+    >>> parse_string_quote_as_spans('de grote ... was lui', 'de grooote grijze vos was lui', fuzzy=.2)
+    [{'start': 0, 'end': 8, 'text': 'de grooo'}, {'start': 22, 'end': 29, 'text': 'was lui'}]
+    >>> parse_string_quote_as_spans('def', 'abc def ghij abc def ghij', already_used=[])
+    [{'start': 4, 'end': 7, 'text': 'def'}]
+    >>> parse_string_quote_as_spans('def', 'abc def ghij abc def ghij', already_used=[(4, 7)])
+    [{'start': 17, 'end': 20, 'text': 'def'}]
+    >>> parse_string_quote_as_spans('And when?', 'What for? And why? And if so, when? And for whom will this be done?')
+    Traceback (most recent call last):
+    ValueError: No match for And when?
+    >>> parse_string_quote_as_spans('And ... when?', 'What for? And why? And if so, when? And for whom will this be done?', fuzzy=0.2, matcher='regex')
+    Traceback (most recent call last):
+    ValueError: Multiple matches for And ... when?
+    >>> parse_string_quote_as_spans('And ... when?', 'What for? And why? And if so, when? And for whom will this be done?', fuzzy=0.2)
+    [{'start': 19, 'end': 22, 'text': 'And'}, {'start': 30, 'end': 35, 'text': 'when?'}]
+    >>> parse_string_quote_as_spans('Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen?', 'Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen? Herinnert u zich uw antwoord dat zoveel mogelijk recht moet worden gedaan aan de keuzevrijheid van de cliënt, maar dat er wel grenzen zijn? Kunt u aangeven waar deze grenzen liggen en waarop deze zijn gebaseerd? .', fuzzy=0.2)
+    [{'start': 0, 'end': 107, 'text': 'Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen?'}]
+    """
+
+    if matcher == 'fast' and spanmatch.supports(quote, original):
+        matches = spanmatch.find_quote_matches(quote, original, fuzzy, min_start=only_from_char)
+    else:
+        quote_regex = dotted_quote_to_regex(quote, fuzzy)
+        matches = list(quote_regex.finditer(original))
+
+    if not matches:
+        raise ValueError(f'No match for {quote}')
+
+    matches = [m for m in matches if m.span()[0] >= only_from_char]
+
+    if not matches:
+        raise ValueError(f'No match for {quote} from character {only_from_char}')
+    elif len(matches) == 1:
+        match = matches[0]
+    elif len(matches) > 1:
+        if already_used is None:
+            raise ValueError(f'Multiple matches for {quote}')
+        else:
+            for match in matches:
+                if match.span(0) not in already_used:
+                    already_used.append(match.span(0))
+                    break
+            else:
+                raise ValueError(f'Multiple matches for {quote}')
+
+    spans = []
+    for n in range(1, len(match.groups()) + 1):
+        start, end = match.span(n)
+        spans.append({'start': start, 'end': end, 'text': match.group(n)})
+
+    return spans
+
+
+@functools.lru_cache(maxsize=1024)
+def dotted_quote_to_regex(quote: str, fuzzy: float, fuzzy_max_e: int = 7) -> 'regex.Regex':
+    """
+    Turn a quote string into a regular expression with optional fuzzy matching.
+    Each part of the quote string is put in a regex capturing group.
+
+    fuzzy_max_e: max number of characters to change (as fuzzy * len(quote) becomes too big); bigger can mean (very) slow.
+
+    >>> dotted_quote_to_regex("The quick brown ... over the ... dog", .2)
+    regex.Regex('(?:(The\\\\ quick\\\\ brown)[^?]+(over\\\\ the)[^?]+(dog)){e<=7}', flags=regex.B | regex.I | regex.V0)
+    """
+    import regex    # (imported here, as it takes a while)
+
+    quote_chunks = quote.split('...')
+    clean_quote_chunks = [regex.escape(chunk.strip()) for chunk in quote_chunks]
+    # make final question marks optional (because LLM often adds them):
+    regex_quote_chunks = [f'({chunk + ("?" if chunk.endswith("?") else "")})' for chunk in clean_quote_chunks]
+    the_regex_str = '(?:' + ('[^?]+'.join(regex_quote_chunks)) + ')'
+
+    if fuzzy:
+        fuzzy_nchars = min(int(math.ceil(fuzzy * len(quote))), fuzzy_max_e)
+        the_regex_str += f'{{e<={fuzzy_nchars}}}'
+
+    return regex.compile(the_regex_str, flags=regex.IGNORECASE + regex.BESTMATCH)
@@ -1,13 +1,22 @@
 import argparse
+import atexit
 import sys
 import logging
 import json
-from transformers import pipeline
 import functools
+import itertools
 
 from llm_utils import *
-from qspan import find_supporting_quote
-import re
+from qspan import find_supporting_quotes
+from parsing import parse_json_or_itemized_list_of_strings, iter_question_tuples, normalize_question
+from response_cache import ResponseCache, CachedPipe
+from constraints import JsonListOfStringsGrammar, JsonListStop
+from spanmatch import UsedSpans
+from align import align_windows
+from examples import ExampleLibrary, load_examples
+from metrics import METRICS
+import metrics
+import qspan
 
 # TODO: Plug in more representative examples.
 
@@ -29,22 +38,45 @@ EXAMPLES = [
 for exe in EXAMPLES:
     exe['response'] = json.dumps(exe['response'])
 
+# For --splitandmerge, where each question is given along with the preceding question(s) as context:
+FOCUS_SYSTEM_PROMPT = SYSTEM_PROMPT + " If a question is preceded by context, split up only the question, using the context only to make the subquestions self-contained."
+FOCUS_PROMPT_FORMAT = 'Context: {context}\n\nQuestion: {target}'
+FOCUSED_EXAMPLES = [
+    {'prompt': FOCUS_PROMPT_FORMAT.format(context='Heeft u de brief van de Indonesische overheid gelezen?', target='Zoja, wat is uw reactie en wanneer stuurt u die?'),
+     'response': json.dumps(['Wat is uw reactie op de brief van de Indonesische overheid?', 'Wanneer stuurt u uw reactie op de brief van de Indonesische overheid?'])},
+    {'prompt': FOCUS_PROMPT_FORMAT.format(context='Sinds wanneer geldt deze maatregel? Wat was destijds de motivatie?', target='Is die motivatie openbaar, en zonee, waarom niet?'),
+     'response': json.dumps(['Is de motivatie voor deze maatregel openbaar?', 'Waarom is de motivatie voor deze maatregel niet openbaar?'])},
+]
+FOCUS_EXAMPLES = EXAMPLES + FOCUSED_EXAMPLES
+
+# The examples to put in the prompts (see use_examples):
+EXAMPLE_LIBRARY = ExampleLibrary(EXAMPLES)
+FOCUS_EXAMPLE_LIBRARY = ExampleLibrary(FOCUS_EXAMPLES)
+
+BATCHES_PER_BLOCK = 8
+
+# The command-line options that affect results (rather than only speed, or the output format):
+RESULT_OPTIONS = ('model', 'server', 'temp', 'topp', 'splitandmerge', 'validate', 'fuzzy', 'retry', 'validate_retry', 'candidates', 'aggregate',
+                  'constrained', 'matcher', 'align', 'examples', 'quote_examples', 'n_examples')
+
 
 # TODO: Include a 'raw' key in the output json? Pass along with the exception?!
 # TODO: Add gradual temperature increase for retrying?!
-# TODO: In case of splitandmerge, adapt the prompt so the model focuses on the last sentence? Will make it far more efficient, too.
 # TODO: The ... doesn't work quite as it should, for discontinuous quotes... maybe |, or csq like "blabla", "blablabla"?
 # TODO: Refactoring.
 # TODO: Tweak logging formats.
-# TODO: Always do multiple tries, and aggregate them? Or choose the response listing the most questions?
 
 def main():
 
+    if sys.argv[1:2] == ['serve']:
+        import daemon
+        return daemon.serve_main(sys.argv[2:])
+
     logging.basicConfig(level=logging.INFO)
 
-    argparser = argparse.ArgumentParser(description='Qsep')
+    argparser = argparse.ArgumentParser(description='Qsep', epilog='Run "qsep serve --help" for keeping the model loaded in a daemon.')
     argparser.add_argument('file', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='Input file, one (composite) question per line; when omitted stdin.')
-    argparser.add_argument('--model', nargs='?', default="unsloth/llama-3-70b-Instruct-bnb-4bit", type=str)
+    argparser.add_argument('--model', nargs='?', default="unsloth/llama-3-70b-Instruct-bnb-4bit", type=str, help='Model name; "test" for a fast, deterministic fake model (see backends.FakeBackend).')
     argparser.add_argument('--list', action='store_true', help='Whether to give a json list with outputs per input, instead of potentially multiple lines per input.')
     argparser.add_argument('--json', action='store_true', help='Whether to give json output instead of plain strings. NB. Interacts with --validate; see README.')
     argparser.add_argument('--validate', action='store_true', help='Use LLM to link replies back to original quotes')
@@ -56,11 +88,36 @@ def main():
     argparser.add_argument('--fuzzy', required=False, type=float, help='For retrieving quotations (if --validate), allow fuzzy matching, as a proportion of total characters.', default=0)
     argparser.add_argument('--retry', required=False, type=int, help='Max number of retries if response failed to parse.', default=5)
     argparser.add_argument('--validate_retry', required=False, type=int, help='Max number of retries if validation response failed to parse.', default=5)
+    argparser.add_argument('--candidates', required=False, type=int, help='Number of responses to sample per attempt, in a single generate call.', default=1)
+    argparser.add_argument('--aggregate', required=False, choices=AGGREGATORS.keys(), help='How to choose among multiple --candidates that parse: the first, the one listing the most subquestions, or by majority vote.', default='first')
+    argparser.add_argument('--prefix-cache', action='store_true', help='Compute the key-value cache of the system prompt and examples only once; chats are then generated one at a time (not in batches).')
+    argparser.add_argument('--align', required=False, type=float, help='If --validate, first try to align subquestions to the original without LLM; use the LLM only if less than this proportion of words could be aligned.', default=None)
+    argparser.add_argument('--matcher', required=False, choices=['fast', 'regex'], help='For retrieving quotations (if --validate): fast (exact, then as few errors as needed), or a fuzzy regex.', default='fast')
+    argparser.add_argument('--constrained', action='store_true', help='Constrain decoding to a JSON list of strings (and, if --validate, quotes to substrings of the original).')
+    argparser.add_argument('--examples', required=False, type=str, help='File with few-shot examples to use instead of the built-in ones: JSON lines, each with a prompt and a response (list of subquestions).', default=None)
+    argparser.add_argument('--quote-examples', required=False, type=str, help='If --validate, file with few-shot examples for quoting, as for qspan --examples.', default=None)
+    argparser.add_argument('--n-examples', required=False, type=int, help='Put only this many examples in each prompt: those most similar to the input (by character n-grams).', default=None)
+    argparser.add_argument('--cache-dir', required=False, type=str, help='Directory for a persistent cache of LLM responses (and validated spans), to avoid regenerating them on re-runs.', default=None)
+    argparser.add_argument('--cache-size', required=False, type=float, help='Max size of the response cache (in MB), beyond which least recently used responses are evicted.', default=1000)
+    argparser.add_argument('--server', required=False, type=str, help='URL of an OpenAI-compatible server (e.g., vLLM) to send requests to, instead of loading --model in-process; --model is then the name the server knows it by.', default=None)
+    argparser.add_argument('--max-in-flight', required=False, type=int, help='With --server, max number of concurrent requests (but no more than --batch-size).', default=32)
+    argparser.add_argument('--batch-size', required=False, type=int, help='Number of inputs to send through the LLM at once (with --server: to have in flight); lines failing to parse are retried in a next batch. Default 1, or with --server --max-in-flight.', default=None)
+    argparser.add_argument('--stream', action='store_true', help='Overlap reading, LLM calls, alignment (if --align) and writing in concurrent stages, writing each output as soon as possible (in input order).')
+    argparser.add_argument('--workers', required=False, type=int, help='With --stream, number of worker processes for --align (matching quotes from the LLM happens during validation, in the LLM thread).', default=2)
+    argparser.add_argument('--queue-size', required=False, type=int, help='With --stream, max number of lines between reading and writing; reading waits when this is reached.', default=64)
+    argparser.add_argument('--socket', required=False, type=str, help='Unix socket of a daemon (see qsep serve) to send jobs to, if it is running; default in $XDG_RUNTIME_DIR or the temp dir.', default=None)
+    argparser.add_argument('--local', action='store_true', help='Load the model in this process even if a daemon is running.')
+    argparser.add_argument('--shards', required=False, type=int, help='Split the input file over this many worker processes, each journaling its results, so that an interrupted run can be resumed by running it again.', default=None)
+    argparser.add_argument('--journal-dir', required=False, type=str, help='With --shards, directory for the journals; default the input file name plus .journal.', default=None)
+    argparser.add_argument('--devices', required=False, nargs='+', help='With --shards, devices to assign the shards to in turn: GPU numbers (e.g., 0 1), or CPU ranges (e.g., cpus:0-15 cpus:16-31).', default=None)
+    argparser.add_argument('--metrics', required=False, type=str, help='Write totals and per-line averages per stage (time, calls, tokens, attempts, failures) to this file: a Prometheus textfile if it ends in .prom, otherwise json.', default=None)
+    argparser.add_argument('--trace', required=False, type=str, help='Write a tracing span per stage to this file (Chrome trace event format).', default=None)
     args = argparser.parse_args()
+    args.batch_size = args.batch_size or (args.max_in_flight if args.server else 1)
 
-    if args.model == 'test':
-        # TODO: Implement a fake language model for easier testing...
-        args.model = 'llamafactory/tiny-random-Llama-3'
+    if args.metrics or args.trace:
+        metrics.enable(tracing=args.trace is not None)
+        atexit.register(METRICS.write, args.metrics, args.trace)
 
     if args.validate and not args.json:
         logging.warning("Are you sure you don't want --json output?")
@@ -68,149 +125,329 @@ def main():
     if args.splitandmerge and not args.validate:
         logging.warning("Are you sure you don't want --validate? Split and merge may result in a lot of duplicates otherwise!")
 
-    pipe = functools.partial(pipeline("text-generation", model=args.model), max_new_tokens=1000, temperature=args.temp, top_p=args.topp)
-    if not args.validate:
-        parser = parse_json_or_itemized_list_of_strings
-    else:
-        # to be further instantiated per input line
-        parser = get_validated_parser(pipe=pipe, validate_n_retries=args.validate_retry, fuzzy=args.fuzzy)
+    if args.shards:
+        return run_sharded(args)
 
-    for n, line in enumerate(args.file):
+    # (imported only here, to keep importing this module, and --help, fast)
+    import daemon
 
-        if n > 0:
-            print()
+    if socket_path := daemon.find_daemon(args, daemon.example_options(args.examples, args.quote_examples, args.n_examples)):
+        options = {option: getattr(args, option) for option in daemon.QSEP_OPTIONS}
+        lines = [line.strip() for line in args.file]
+        results = daemon.request_daemon(socket_path, ({'task': 'qsep', 'line': line, 'options': options} for line in lines))
+        try:
+            for (n, line), result in zip(enumerate(lines), results):
+                METRICS.count('lines')
+                print(*format_output(n, line, result, as_list=args.list, as_json=args.json, validate=args.validate), sep='\n')
+        except daemon.DaemonError as e:
+            sys.exit(str(e))
+        return
+
+    set_examples(args)
+    pipe = make_pipe(args)
+
+    if args.stream:
+        from stream import run_streaming
+
+        def write_output(n, line, result):
+            METRICS.count('lines')
+            print(*format_output(n, line, result, as_list=args.list, as_json=args.json, validate=args.validate), sep='\n', flush=True)
+
+        run_streaming(((n, line.strip()) for n, line in enumerate(args.file)),
+                      split=functools.partial(split_lines, pipe=pipe, n_retries=args.retry, batch_size=args.batch_size, splitandmerge=args.splitandmerge,
+                                              n_candidates=args.candidates, aggregate=args.aggregate, constrained=args.constrained),
+                      align=functools.partial(align_windows, align_threshold=args.align) if args.validate and args.align is not None else None,
+                      validate=functools.partial(finish_windows, pipe=pipe, validate=args.validate, validate_n_retries=args.validate_retry, fuzzy=args.fuzzy, merge=args.splitandmerge is not None,
+                                                 n_candidates=args.candidates, constrained=args.constrained, matcher=args.matcher, align_threshold=args.align),
+                      write=write_output,
+                      batch_size=args.batch_size, max_in_flight=args.queue_size, n_workers=args.workers)
+        return
+
+    numbered_lines = ((n, line.strip()) for n, line in enumerate(args.file))
+    for block, results in separate_questions_in_blocks(numbered_lines, pipe, args):
+        for (n, line), result in zip(block, results):
+            METRICS.count('lines')
+            for output_line in format_output(n, line, result, as_list=args.list, as_json=args.json, validate=args.validate):
+                print(output_line)
+
+
+def make_pipe(args):
+    from backends import make_backend
+
+    pipe = make_backend(args.model, server=args.server, max_in_flight=args.max_in_flight, max_new_tokens=1000, temperature=args.temp, top_p=args.topp)
+    if args.cache_dir:
+        pipe = CachedPipe(pipe, ResponseCache(args.cache_dir, max_size=args.cache_size * 1e6), model_name=args.model)
+    if args.prefix_cache and args.n_examples is not None:
+        logging.warning('With --n-examples, prompts have no fixed prefix to cache; ignoring --prefix-cache.')
+    elif args.prefix_cache:
+        if args.batch_size > 1:
+            logging.warning('With --prefix-cache, chats are generated one at a time; --batch-size only groups them.')
+        if args.splitandmerge is not None:
+            register_prefix_cache(pipe, 'qsep-focus', FOCUS_EXAMPLE_LIBRARY.examples, FOCUS_SYSTEM_PROMPT, FOCUS_PROMPT_FORMAT[:FOCUS_PROMPT_FORMAT.index('{')])
+        else:
+            register_prefix_cache(pipe, 'qsep', EXAMPLE_LIBRARY.examples, SYSTEM_PROMPT)
+        if args.validate:
+            register_prefix_cache(pipe, 'qspan', qspan.EXAMPLE_LIBRARY.examples, qspan.SYSTEM_PROMPT, qspan.PROMPT_START)
+    return pipe
 
-        line = line.strip()
-        if not line:
-            logging.warning(f'Empty line on input line {n}')
-            if args.list:
-                print(json.dumps([]))
-            else:
-                print()
-            continue
 
-        if args.splitandmerge is not None:
-            # TODO: Refactor
+def use_examples(path=None, k=None):
+    """
+    Replace the built-in examples by those in a file (see --examples), and/or put only the k most similar ones in
+    each prompt.
+    """
+    global EXAMPLE_LIBRARY, FOCUS_EXAMPLE_LIBRARY
+    examples = EXAMPLES
+    if path:
+        examples = [{**example, 'response': json.dumps(example['response'])} for example in load_examples(path)]
+    EXAMPLE_LIBRARY = ExampleLibrary(examples, k=k)
+    FOCUS_EXAMPLE_LIBRARY = ExampleLibrary(examples + FOCUSED_EXAMPLES, k=k)
 
-            result = []
 
-            for chunk_start, target_start, chunk_text in iter_question_tuples(line, args.splitandmerge):
-                if args.validate:
-                    parser = functools.partial(parser, original_text=chunk_text, char_offset=chunk_start, only_from_char=target_start, already_used=[])
+def set_examples(args):
+    use_examples(args.examples, args.n_examples)
+    qspan.use_examples(args.quote_examples, args.n_examples)
 
-                chat_start = make_chat_start(chunk_text, EXAMPLES, SYSTEM_PROMPT)
-                try:
-                    subresult = retry_until_parse(pipe, chat_start, parser, args.retry)
-                except ValueError as e:
-                    logging.warning(f'Failed parsing response for input chunk {n}.{chunk_start}; {e}')
-                    continue
 
-                if args.validate:
-                    # for validate in the case of split and merge, don't keep the Nones, or we get too many duplicates:
-                    subresult = [r for r in subresult if r['spans'] is not None]
+def separate_questions_in_blocks(numbered_lines, pipe, args):
+    """
+    Yields blocks of (n, line) along with their results, as per the command-line args.
+    """
+    # Lines are read in blocks of several batches, so that lines of similar length can be batched together:
+    block_size = args.batch_size * BATCHES_PER_BLOCK if args.batch_size > 1 else 1
+    while block := list(itertools.islice(numbered_lines, block_size)):
+        yield block, separate_questions(block, pipe, n_retries=args.retry, batch_size=args.batch_size,
+                                        splitandmerge=args.splitandmerge, validate=args.validate,
+                                        validate_n_retries=args.validate_retry, fuzzy=args.fuzzy,
+                                        n_candidates=args.candidates, aggregate=args.aggregate, constrained=args.constrained,
+                                        matcher=args.matcher, align_threshold=args.align)
 
-                result.extend(subresult)
 
-        else:
-            if args.validate:
-                parser = functools.partial(parser, original_text=line, already_used=[])
-
-            chat_start = make_chat_start(line, EXAMPLES, SYSTEM_PROMPT)
-            try:
-                result = retry_until_parse(pipe, chat_start, parser, args.retry)
-            except ValueError as e:
-                logging.warning(f'Failed parsing response for input line {n}; {e}')
-                continue
-
-        # TODO: Refactor the various output formats
-        if args.validate and not args.json:
-            result = [res['rephrased'] for res in result]
-        if args.list:
-            if args.json:
-                print(json.dumps(result))
-            else:
-                print(result) # TODO: Should be csv.
-        else:
-            for res in result:
-                if args.json:
-                    print(json.dumps(res))
-                else:
-                    print(res)
+def run_sharded(args):
+    """
+    Runs args.shards worker processes (see shards.py), then prints the merged results. Failed shards can be resumed
+    by running the same command again.
+    """
+    import shards
+
+    if args.file is sys.stdin:
+        sys.exit('--shards requires an input file (rather than stdin), to be able to resume.')
+    input_path = args.file.name
+    journal_dir = args.journal_dir or input_path + '.journal'
+    args.file = None    # (can't be sent to the worker processes)
+
+    if not shards.check_meta(journal_dir, {option: getattr(args, option) for option in RESULT_OPTIONS}):
+        sys.exit(f'{journal_dir} holds results of a run with different options (see its meta.json); remove it, or give another --journal-dir.')
+
+    if failed := shards.run_sharded(functools.partial(run_shard, input_path=input_path, args=args), journal_dir, args.shards, args.devices):
+        sys.exit(f'Shards {failed} failed; their results so far are in {journal_dir}.')
+
+    records = shards.merge_journals(journal_dir, args.shards)
+    with open(input_path) as file:
+        for n, line in enumerate(file):
+            result = records[n]['result'] if n in records else None
+            for output_line in format_output(n, line.strip(), result, as_list=args.list, as_json=args.json, validate=args.validate):
+                print(output_line)
+
+
+def run_shard(shard, n_shards, journal_path, input_path, args):
+    import shards
+
+    logging.basicConfig(level=logging.INFO, format=f'%(levelname)s:shard {shard}:%(message)s')
+    if args.metrics or args.trace:
+        metrics.enable(tracing=args.trace is not None)
+        atexit.register(METRICS.write, shards.shard_file(args.metrics, shard), shards.shard_file(args.trace, shard))
+    done = shards.read_journal(journal_path)
+    with open(input_path) as file:
+        numbered_lines = [(n, line.strip()) for n, line in enumerate(file) if n % n_shards == shard]
+    if any(done[n]['line'] != line for n, line in numbered_lines if n in done):
+        sys.exit(f'Input file has changed since {journal_path} was written.')
+    numbered_lines = [(n, line) for n, line in numbered_lines if n not in done]
+    logging.info('%d lines done before, %d to go.', len(done), len(numbered_lines))
+    if not numbered_lines:
+        return
+
+    set_examples(args)
+    pipe = make_pipe(args)
+    for block, results in separate_questions_in_blocks(iter(numbered_lines), pipe, args):
+        METRICS.count('lines', len(block))
+        shards.append_to_journal(journal_path, [{'n': n, 'line': line, 'result': result} for (n, line), result in zip(block, results)])
+
+
+def separate_questions(numbered_lines, pipe, n_retries, batch_size=1, splitandmerge=None, validate=False, validate_n_retries=5, fuzzy=0.0, n_candidates=1, aggregate='first', constrained=False, matcher='fast', align_threshold=None):
+    """
+    Splits each of the (stripped) lines into subquestions, sending all lines (or their chunks, if splitandmerge)
+    through the LLM in batches.
+
+    Returns, per line, a list of subquestions (or of dicts with spans, if validate), or None if the LLM response
+    could not be parsed (or if the line was empty).
+    """
+    windows_per_line = split_lines(numbered_lines, pipe, n_retries, batch_size=batch_size, splitandmerge=splitandmerge,
+                                   n_candidates=n_candidates, aggregate=aggregate, constrained=constrained)
+    return [None if windows is None else finish_windows(windows, pipe=pipe, validate=validate, validate_n_retries=validate_n_retries, fuzzy=fuzzy,
+                                                        merge=splitandmerge is not None, n_candidates=n_candidates, constrained=constrained, matcher=matcher, align_threshold=align_threshold)
+            for windows in windows_per_line]
 
 
-def iter_question_tuples(line: str, n_per_tuple: int):
+@METRICS.stage('split')
+def split_lines(numbered_lines, pipe, n_retries, batch_size=1, splitandmerge=None, n_candidates=1, aggregate='first', constrained=False):
     """
-    >>> list(iter_question_tuples('Test? Hello? Not sure?', 1))
-    [(0, 0, 'Test?'), (5, 5, ' Hello?'), (12, 12, ' Not sure?')]
-    >>> list(iter_question_tuples('Test? Hello? Not sure?', 2))
-    [(0, 0, 'Test?'), (0, 5, 'Test? Hello?'), (5, 12, ' Hello? Not sure?')]
+    The LLM part of separate_questions, without validation. Returns, per line, None (if empty or failed), or a list
+    of windows (original_text, char_offset, subquestions): the whole line, or if splitandmerge, the target question
+    of each chunk whose response could be parsed, with its subquestions that weren't already found for an earlier one.
     """
+    jobs = []
+    for i, (n, line) in enumerate(numbered_lines):
+        if not line:
+            continue
+        if splitandmerge is not None:
+            jobs.extend((i, chunk_start, target_start, chunk_text) for chunk_start, target_start, chunk_text in iter_question_tuples(line, splitandmerge))
+        else:
+            jobs.append((i, 0, 0, line))
 
-    questions = [None] * (n_per_tuple - 1) + list(re.finditer(r'[^?]+\?', line))    # lookahead, but caused misses: (?=(?: +[A-Z])|(?: *$))
-    tuples = zip(*[questions[n:] for n in range(n_per_tuple)])
-    for questions_tuple in tuples:
-        questions_tuple = tuple(filter(None, questions_tuple))
-        chunk_start = questions_tuple[0].span()[0]
-        target_start = questions_tuple[-1].span()[0]
-        chunk_text = ''.join(match.group() for match in questions_tuple)
+    if splitandmerge is not None:
+        prompts = [make_focused_prompt(chunk_text, target_start - chunk_start) for i, chunk_start, target_start, chunk_text in jobs]
+        chat_starts = [make_chat_start(prompt, FOCUS_EXAMPLE_LIBRARY.select(prompt), FOCUS_SYSTEM_PROMPT) for prompt in prompts]
+    else:
+        chat_starts = [make_chat_start(chunk_text, EXAMPLE_LIBRARY.select(chunk_text), SYSTEM_PROMPT) for *_, chunk_text in jobs]
+    # subquestions, made self-contained, can together be several times longer than the question they derive from:
+    max_new_tokens = [token_budget(pipe, chunk_text, per_token=4) for *_, chunk_text in jobs]
+    # with constrained decoding there will be no "Here is the answer:" to skip:
+    subresults = retry_until_parse_batch(pipe, chat_starts, parse_json_or_itemized_list_of_strings, n_retries, batch_size,
+                                         n_candidates=n_candidates, aggregate=aggregate, try_skip_first_line=not constrained,
+                                         grammar=JsonListOfStringsGrammar() if constrained else None, stop=JsonListStop(),
+                                         max_new_tokens=max_new_tokens)
+
+    windows_per_line = [[] if line and splitandmerge is not None else None for n, line in numbered_lines]
+    seen_questions = [set() for _ in numbered_lines]
+    for (i, chunk_start, target_start, chunk_text), subresult in zip(jobs, subresults):
+        if subresult is None:
+            if splitandmerge is not None:
+                logging.warning(f'Failed parsing response for input chunk {numbered_lines[i][0]}.{chunk_start}')
+            continue
 
-        yield chunk_start, target_start, chunk_text
+        if splitandmerge is not None:
+            # overlapping windows may still yield the same subquestion; don't validate it twice:
+            subresult = deduplicate(subresult, key=normalize_question, seen=seen_questions[i])
+            # subquestions of a focused prompt derive from the target question only:
+            window = (chunk_text[target_start - chunk_start:], target_start, subresult)
+        else:
+            window = (chunk_text, 0, subresult)
 
+        if windows_per_line[i] is None:
+            windows_per_line[i] = []
+        windows_per_line[i].append(window)
 
+    return windows_per_line
 
-def get_validated_parser(pipe, validate_n_retries, fuzzy):
 
-    def parser(raw, original_text, char_offset=0, only_from_char=0, already_used=[]):
-        results = []
-        for rephrased in parse_json_or_itemized_list_of_strings(raw):
-            spans = find_supporting_quote(original=original_text, rephrased=rephrased, pipe=pipe,
-                                          n_retries=validate_n_retries, fail_ok=True, already_used=already_used,
-                                          fuzzy=fuzzy, only_from_char=only_from_char - char_offset)
-            if char_offset and spans is not None:
-                for span in spans:
-                    span['start'] += char_offset
-                    span['end'] += char_offset
+@METRICS.stage('validate')
+def finish_windows(windows, aligned_per_window=None, pipe=None, validate=False, validate_n_retries=5, fuzzy=0.0, merge=False, n_candidates=1, constrained=False, matcher='fast', align_threshold=None):
+    """
+    The validation part of separate_questions, for a single line's windows (as returned by split_lines); without
+    validate, just the subquestions. If merge (i.e., splitandmerge), subquestions without spans, or with the same
+    spans as an earlier one, are dropped. aligned_per_window can give the result of align_windows, if already done.
+    """
+    if not validate:
+        return [question for *_, subquestions in windows for question in subquestions]
+
+    results = []
+    seen_spans = set()
+    for n_window, (original_text, char_offset, subquestions) in enumerate(windows):
+        subresult = validate_subquestions(subquestions, original_text=original_text, pipe=pipe,
+                                          validate_n_retries=validate_n_retries, fuzzy=fuzzy, n_candidates=n_candidates, constrained=constrained, matcher=matcher, align_threshold=align_threshold,
+                                          char_offset=char_offset, only_from_char=char_offset, already_used=UsedSpans(),
+                                          aligned=aligned_per_window and aligned_per_window[n_window])
+        METRICS.count('subquestions', len(subresult))
+        METRICS.count('unvalidated', sum(r['spans'] is None for r in subresult))
+        if merge:
+            # for validate in the case of split and merge, don't keep the Nones, or we get too many duplicates:
+            subresult = [r for r in subresult if r['spans'] is not None]
+            subresult = deduplicate(subresult, key=lambda r: tuple((span['start'], span['end']) for span in r['spans']), seen=seen_spans)
+        results.extend(subresult)
+    return results
+
+
+def format_output(n, line, result, as_list=False, as_json=False, validate=False) -> list[str]:
+    """
+    The output lines for input line n, starting with a blank line (to separate it from the previous one) if n > 0.
 
-            result = {
-                'spans': spans,
-                'rephrased': rephrased,
-            }
-            results.append(result)
+    >>> format_output(1, 'Wie en wat?', ['Wie?', 'Wat?'])
+    ['', 'Wie?', 'Wat?']
+    >>> format_output(0, 'Wie en wat?', [{'spans': None, 'rephrased': 'Wie?'}], as_list=True, as_json=True, validate=True)
+    ['[{"spans": null, "rephrased": "Wie?"}]']
+    """
+    output = [''] if n > 0 else []
+
+    if not line:
+        logging.warning(f'Empty line on input line {n}')
+        output.append(json.dumps([]) if as_list else '')
+        return output
+
+    if result is None:
+        logging.warning(f'Failed parsing response for input line {n}')
+        return output
+
+    # TODO: Refactor the various output formats
+    if validate and not as_json:
+        result = [res['rephrased'] for res in result]
+    if as_list:
+        if as_json:
+            output.append(json.dumps(result))
+        else:
+            output.append(str(result)) # TODO: Should be csv.
+    else:
+        for res in result:
+            if as_json:
+                output.append(json.dumps(res))
+            else:
+                output.append(str(res))
+    return output
 
-        return results
 
-    return parser
+def make_focused_prompt(chunk_text, target_start):
+    """
+    >>> print(make_focused_prompt('Test? Hello?', 5))
+    Context: Test?
+    <BLANKLINE>
+    Question: Hello?
+    >>> make_focused_prompt('Test?', 0)
+    'Test?'
+    """
+    context, target = chunk_text[:target_start].strip(), chunk_text[target_start:].strip()
+    return FOCUS_PROMPT_FORMAT.format(context=context, target=target) if context else target
 
 
-def parse_json_or_itemized_list_of_strings(raw):
-    try:
-        return parse_json_list_of_strings(raw)
-    except ValueError as e1:
-        try:
-            return parse_itemized_list_of_strings(raw)
-        except ValueError as e2:
-            raise ValueError(f'{e1}; {e2}')
-
-
-def parse_json_list_of_strings(raw):
-    try:
-        result = json.loads(raw)
-    except json.JSONDecodeError:
-        raise ValueError('Not a json string')
-    if not isinstance(result, list):
-        raise ValueError('Not a list')
-    if any(not isinstance(x, str) for x in result):
-        raise ValueError('List contains a non-string')
+def deduplicate(items, key, seen):
+    """
+    Keep only items whose key isn't in seen (updating seen).
+    """
+    result = []
+    for item in items:
+        if (item_key := key(item)) not in seen:
+            seen.add(item_key)
+            result.append(item)
     return result
 
 
-enum_regex = re.compile(r'[ \t]*\d+. +([^\n]+)')
-item_regex = re.compile(r'[ \t]*- +([^\n]+)')
-
-def parse_itemized_list_of_strings(raw):
-    if len(result := enum_regex.findall(raw)) <= 1 and len(result := item_regex.findall(raw)) <= 1:
-        raise ValueError('Not an itemized/enumerated list of strings')
-    return [s.strip('"\'') for s in result]
+def validate_subquestions(rephrased_list, original_text, pipe, validate_n_retries, fuzzy, char_offset=0, only_from_char=0, already_used=None, n_candidates=1, constrained=False, matcher='fast', align_threshold=None, aligned=None):
+    all_spans = find_supporting_quotes(original=original_text, rephrased_list=rephrased_list, pipe=pipe,
+                                       n_retries=validate_n_retries, already_used=already_used, n_candidates=n_candidates, constrained=constrained, matcher=matcher, align_threshold=align_threshold, aligned=aligned,
+                                       fuzzy=fuzzy, only_from_char=only_from_char - char_offset)
+    results = []
+    for rephrased, spans in zip(rephrased_list, all_spans):
+        if char_offset and spans is not None:
+            for span in spans:
+                span['start'] += char_offset
+                span['end'] += char_offset
+
+        result = {
+            'spans': spans,
+            'rephrased': rephrased,
+        }
+        results.append(result)
+
+    return results
 
 
 if __name__ == '__main__':
@@ -1,15 +1,24 @@
 import argparse
+import atexit
 import sys
 import logging
-from transformers import pipeline
 import functools
+import itertools
 from llm_utils import *
+from parsing import parse_string_quote_as_spans
+from response_cache import ResponseCache, CachedPipe, find_cached_pipe
+from constraints import QuoteGrammar, LineStop
+from align import align_quote, align_quotes
+from examples import ExampleLibrary, load_examples
 import csv
-import regex
-import math
+
+import spanmatch
+from metrics import METRICS, OneLine
+import metrics
 
 
 PROMPT_FORMAT = '> {original}\n\nGive an exact, literal quote from this passage that conveys the same intent as "{rephrase}", and no more.'
+PROMPT_START = PROMPT_FORMAT[:PROMPT_FORMAT.index('{')]    # constant part, for the prefix cache
 
 SYSTEM_PROMPT = "You are a system that can match paraphrases to the original quotations in the source text, specialized in questions, in particular for the Dutch language."
 
@@ -44,8 +53,11 @@ EXAMPLES = [
 
 for exe in EXAMPLES:
     exe['prompt'] = PROMPT_FORMAT.format(original=exe['original'], rephrase=exe['rephrase'])
-    del exe['original']
-    del exe['rephrase']
+
+BATCHES_PER_BLOCK = 8
+
+# The examples to put in the prompts, selected by similarity of their original (see use_examples):
+EXAMPLE_LIBRARY = ExampleLibrary(EXAMPLES, key='original')
 
 
 def main():
@@ -54,142 +66,272 @@ def main():
 
     argparser = argparse.ArgumentParser(description='Qsep')
     argparser.add_argument('file', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='Input file with pairs original,rephrased per line (csv); when omitted read from stdin.')
-    argparser.add_argument('--model', nargs='?', default="unsloth/llama-3-70b-Instruct-bnb-4bit", type=str)
+    argparser.add_argument('--model', nargs='?', default="unsloth/llama-3-70b-Instruct-bnb-4bit", type=str, help='Model name; "test" for a fast, deterministic fake model (see backends.FakeBackend).')
     argparser.add_argument('--json', action='store_true', help='Whether to give json output; otherwise each question on a new line, with empty line per input.')
     argparser.add_argument('--temp', required=False, type=float, help='Temperature', default=.1)
     argparser.add_argument('--topp', required=False, type=float, help='Sample only from top probability', default=None)
     argparser.add_argument('--fuzzy', required=False, type=float, help='For retrieving quotations, allow fuzzy matching, as a proportion of total characters.', default=0.0)
     argparser.add_argument('--retry', required=False, type=int, help='Max number of retries if response failed to parse.', default=5)
+    argparser.add_argument('--candidates', required=False, type=int, help='Number of responses to sample per attempt; the first that parses is used.', default=1)
+    argparser.add_argument('--prefix-cache', action='store_true', help='Compute the key-value cache of the system prompt and examples only once; chats are then generated one at a time (not in batches).')
+    argparser.add_argument('--align', required=False, type=float, help='First try to align the rephrased question to the original without LLM; use the LLM only if less than this proportion of words could be aligned.', default=None)
+    argparser.add_argument('--matcher', required=False, choices=['fast', 'regex'], help='Engine for matching quotes to the original: fast (exact, then as few errors as needed), or a fuzzy regex.', default='fast')
+    argparser.add_argument('--constrained', action='store_true', help='Constrain decoding to quotes consisting of substrings of the original.')
+    argparser.add_argument('--examples', required=False, type=str, help='File with few-shot examples to use instead of the built-in ones: JSON lines, each with an original, a rephrase and a response (the quote).', default=None)
+    argparser.add_argument('--n-examples', required=False, type=int, help='Put only this many examples in each prompt: those whose original is most similar to the input (by character n-grams).', default=None)
+    argparser.add_argument('--cache-dir', required=False, type=str, help='Directory for a persistent cache of LLM responses, to avoid regenerating them on re-runs.', default=None)
+    argparser.add_argument('--cache-size', required=False, type=float, help='Max size of the response cache (in MB), beyond which least recently used responses are evicted.', default=1000)
+    argparser.add_argument('--server', required=False, type=str, help='URL of an OpenAI-compatible server (e.g., vLLM) to send requests to, instead of loading --model in-process; --model is then the name the server knows it by.', default=None)
+    argparser.add_argument('--max-in-flight', required=False, type=int, help='With --server, max number of concurrent requests (but no more than --batch-size).', default=32)
+    argparser.add_argument('--batch-size', required=False, type=int, help='Number of inputs to send through the LLM at once (with --server: to have in flight); rows failing to parse are retried in a next batch. Default 1, or with --server --max-in-flight.', default=None)
+    argparser.add_argument('--socket', required=False, type=str, help='Unix socket of a daemon (see qsep serve) to send jobs to, if it is running; default in $XDG_RUNTIME_DIR or the temp dir.', default=None)
+    argparser.add_argument('--local', action='store_true', help='Load the model in this process even if a daemon is running.')
+    argparser.add_argument('--metrics', required=False, type=str, help='Write totals and per-line averages per stage (time, calls, tokens, attempts, failures) to this file: a Prometheus textfile if it ends in .prom, otherwise json.', default=None)
+    argparser.add_argument('--trace', required=False, type=str, help='Write a tracing span per stage to this file (Chrome trace event format).', default=None)
     args = argparser.parse_args()
+    args.batch_size = args.batch_size or (args.max_in_flight if args.server else 1)
 
-    if args.model == 'test':
-        args.model = 'llamafactory/tiny-random-Llama-3'
-
-    pipe = functools.partial(pipeline("text-generation", model=args.model), max_new_tokens=1000, temperature=args.temp, top_p=args.topp)
-    for n, (original, rephrased) in enumerate(csv.reader(args.file)):
-        try:
-            result = find_supporting_quote(original, rephrased, pipe, n_retries=args.retry, fuzzy=args.fuzzy)
-        except ValueError as e:
-            logging.warning(f'Failed parsing response for input {n}; {e}')
-            print()
-        else:
-            if args.json:
-                print(json.dumps(result))
-            else:
-                for res in result:
-                    print(res)
-        print()
-
-
-def find_supporting_quote(original: str, rephrased: str, pipe, n_retries: int, fail_ok=False, already_used=None, fuzzy=0.0, only_from_char=0):
-    prompt = PROMPT_FORMAT.format(original=original, rephrase=rephrased)
-    chat_start = make_chat_start(prompt, EXAMPLES, SYSTEM_PROMPT)
-    return retry_until_parse(pipe,
-                             chat_start,
-                             parser=functools.partial(parse_string_quote_as_spans, original=original, already_used=already_used, fuzzy=fuzzy, only_from_char=only_from_char),
-                             n_retries=n_retries,
-                             fail_ok=fail_ok,
-                             try_skip_first_line=False)
-
-
-# # Currently disabled because I don't think LLMs can count characters, and handling discontinuous spans not yet attempted.
-#
-# def parse_json_quote_as_spans(quote: str, original: str, fuzzy=0.0, already_used=None) -> list[dict]:
-#     try:
-#         d = json.loads(quote)
-#     except json.JSONDecodeError as e:
-#         raise ValueError(f"No valid JSON in {quote}")
-#
-#     if 'start' not in d or 'end' not in d or 'text' not in d:
-#         raise ValueError(f"Key missing in {quote}")
-#
-#     start, end, text = d['start'], d['end'], d['text']
-#     if not (0 <= start <= end <= len(original)):
-#         raise ValueError(f"No proper start/end indices in {quote}")
-#
-#     target = original[start:end]
-#     if target != text:
-#         raise ValueError(f"Start:end results in different string ({text} != {target}) for {quote}")
-#
-#     parse_string_quote_as_spans(text, original, fuzzy, already_used)
-#
+    if args.metrics or args.trace:
+        metrics.enable(tracing=args.trace is not None)
+        atexit.register(METRICS.write, args.metrics, args.trace)
 
+    # (imported only here, to keep importing this module, and --help, fast)
+    import daemon
+    from backends import make_backend
 
-# TODO: Implement in-dialogue-retrying with feedback
-
-
-def parse_string_quote_as_spans(quote: str, original: str, fuzzy=0.0, already_used=None, only_from_char=0) -> list[dict]:
+    examples = daemon.example_options(quote_examples=args.examples, n_examples=args.n_examples)
+    del examples['examples']    # (qsep's, for splitting)
+    if socket_path := daemon.find_daemon(args, examples):
+        options = {option: getattr(args, option) for option in daemon.QSPAN_OPTIONS}
+        requests = ({'task': 'qspan', 'original': original, 'rephrased': rephrased, 'options': options} for original, rephrased in csv.reader(args.file))
+        try:
+            for n, result in enumerate(daemon.request_daemon(socket_path, requests)):
+                METRICS.count('lines')
+                if result is None:
+                    logging.warning(f'Failed parsing response for input {n}')
+                print(*format_output(result, as_json=args.json), sep='\n')
+        except daemon.DaemonError as e:
+            sys.exit(str(e))
+        return
+
+    pipe = make_backend(args.model, server=args.server, max_in_flight=args.max_in_flight, max_new_tokens=1000, temperature=args.temp, top_p=args.topp)
+    if args.cache_dir:
+        pipe = CachedPipe(pipe, ResponseCache(args.cache_dir, max_size=args.cache_size * 1e6), model_name=args.model)
+    use_examples(args.examples, args.n_examples)
+    if args.prefix_cache and args.n_examples is not None:
+        logging.warning('With --n-examples, prompts have no fixed prefix to cache; ignoring --prefix-cache.')
+    elif args.prefix_cache:
+        if args.batch_size > 1:
+            logging.warning('With --prefix-cache, chats are generated one at a time; --batch-size only groups them.')
+        register_prefix_cache(pipe, 'qspan', EXAMPLE_LIBRARY.examples, SYSTEM_PROMPT, PROMPT_START)
+    # Rows are read in blocks of several batches, so that rows of similar length can be batched together:
+    rows = csv.reader(args.file)
+    n = 0
+    while block := list(itertools.islice(rows, args.batch_size * BATCHES_PER_BLOCK)):
+        METRICS.count('lines', len(block))
+        with METRICS.stage('qspan'):
+            results = find_supporting_quote_batch(block, pipe, n_retries=args.retry, batch_size=args.batch_size, fuzzy=args.fuzzy, n_candidates=args.candidates,
+                                                  constrained=args.constrained, matcher=args.matcher, align_threshold=args.align)
+        for result in results:
+            if result is None:
+                logging.warning(f'Failed parsing response for input {n}')
+            print(*format_output(result, as_json=args.json), sep='\n')
+            n += 1
+
+
+def use_examples(path=None, k=None):
     """
-    >>> parse_string_quote_as_spans('de grote ... was lui', 'de grote grijze vos was lui')
-    [{'start': 0, 'end': 8, 'text': 'de grote'}, {'start': 20, 'end': 27, 'text': 'was lui'}]
-    >>> parse_string_quote_as_spans('de grote ... was lui', 'de grooote grijze vos was lui', fuzzy=.2)
-    [{'start': 0, 'end': 8, 'text': 'de grooo'}, {'start': 22, 'end': 29, 'text': 'was lui'}]
-    >>> parse_string_quote_as_spans('def', 'abc def ghij abc def ghij', already_used=[])
-    [{'start': 4, 'end': 7, 'text': 'def'}]
-    >>> parse_string_quote_as_spans('def', 'abc def ghij abc def ghij', already_used=[(4, 7)])
-    [{'start': 17, 'end': 20, 'text': 'def'}]
-    >>> parse_string_quote_as_spans('And when?', 'What for? And why? And if so, when? And for whom will this be done?')
-    Traceback (most recent call last):
-    ValueError: No match for And when?
-    >>> parse_string_quote_as_spans('And ... when?', 'What for? And why? And if so, when? And for whom will this be done?', fuzzy=0.2)
-    Traceback (most recent call last):
-    ValueError: Multiple matches for And ... when?
-    >>> parse_string_quote_as_spans('Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen?', 'Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen? Herinnert u zich uw antwoord dat zoveel mogelijk recht moet worden gedaan aan de keuzevrijheid van de cliënt, maar dat er wel grenzen zijn? Kunt u aangeven waar deze grenzen liggen en waarop deze zijn gebaseerd? .', fuzzy=0.2)
-    [{'start': 0, 'end': 107, 'text': 'Herinnert u zich mijn schriftelijke vragen over het weigeren van mannelijke artsen door gesluierde vrouwen?'}]
+    Replace the built-in examples by those in a file (see --examples), and/or put only the k most similar ones in
+    each prompt.
     """
+    global EXAMPLE_LIBRARY
+    examples = EXAMPLES
+    if path:
+        examples = [{**example, 'prompt': PROMPT_FORMAT.format(original=example['original'], rephrase=example['rephrase'])} for example in load_examples(path)]
+    EXAMPLE_LIBRARY = ExampleLibrary(examples, key='original', k=k)
 
-    quote_regex = dotted_quote_to_regex(quote, fuzzy)
-    matches = list(quote_regex.finditer(original))
 
-    if not matches:
-        raise ValueError(f'No match for {quote}')
-
-    matches = [m for m in matches if m.span()[0] >= only_from_char]
-
-    if not matches:
-        raise ValueError(f'No match for {quote} from character {only_from_char}')
-    elif len(matches) == 1:
-        match = matches[0]
-    elif len(matches) > 1:
-        if already_used is None:
-            raise ValueError(f'Multiple matches for {quote}')
-        else:
-            for match in matches:
-                if match.span(0) not in already_used:
-                    already_used.append(match.span(0))
-                    break
-            else:
-                raise ValueError(f'Multiple matches for {quote}')
+def format_output(result, as_json=False) -> list[str]:
+    """
+    The output lines for one input, ending with a blank line; only that, if it failed.
 
-    spans = []
-    for n in range(1, len(match.groups()) + 1):
-        start, end = match.span(n)
-        spans.append({'start': start, 'end': end, 'text': match.group(n)})
+    >>> format_output([{'start': 0, 'end': 3, 'text': 'Wie'}], as_json=True)
+    ['[{"start": 0, "end": 3, "text": "Wie"}]', '']
+    >>> format_output(None)
+    ['', '']
+    """
+    if result is None:
+        return ['', '']
+    if as_json:
+        return [json.dumps(result), '']
+    return [str(res) for res in result] + ['']
 
-    return spans
 
+def find_supporting_quote(original: str, rephrased: str, pipe, n_retries: int, fail_ok=False, already_used=None, fuzzy=0.0, only_from_char=0, n_candidates=1, constrained=False, matcher='fast', align_threshold=None):
+    """
+    If align_threshold is given, first tries to align rephrased to the original without an LLM (see align.py),
+    using the LLM only if the proportion of aligned words is below the threshold.
+    """
+    if align_threshold is not None:
+        used = None if already_used is None else spanmatch.UsedSpans(already_used)
+        spans, confidence = align_quote(original, rephrased, only_from_char=only_from_char, already_used=used)
+        if spans is not None and confidence >= align_threshold:
+            if already_used is not None:
+                already_used.extend(used[len(already_used):])
+            return spans
 
-def dotted_quote_to_regex(quote: str, fuzzy: float, fuzzy_max_e: int = 7) -> regex.Regex:
+    prompt = PROMPT_FORMAT.format(original=original, rephrase=rephrased)
+    chat_start = make_chat_start(prompt, EXAMPLE_LIBRARY.select(original), SYSTEM_PROMPT)
+    search = lambda used: retry_until_parse(pipe,
+                                            chat_start,
+                                            parser=functools.partial(parse_string_quote_as_spans, original=original, already_used=used, fuzzy=fuzzy, only_from_char=only_from_char, matcher=matcher),
+                                            n_retries=n_retries,
+                                            fail_ok=fail_ok,
+                                            try_skip_first_line=False,
+                                            n_candidates=n_candidates,
+                                            grammar=QuoteGrammar(original) if constrained else None,
+                                            stop=LineStop(),
+                                            max_new_tokens=token_budget(pipe, original))
+    key_parts = ('find_supporting_quote', original, rephrased, n_retries, fuzzy, only_from_char, n_candidates, constrained, matcher)
+    return cached_quote_search(pipe, original, key_parts, already_used, search)
+
+
+def find_supporting_quotes(original: str, rephrased_list: list[str], pipe, n_retries: int, already_used=None, fuzzy=0.0, only_from_char=0, increase_temp=.1, n_candidates=1, constrained=False, matcher='fast', align_threshold=None, aligned=None) -> list:
+    """
+    Like find_supporting_quote, but for many rephrasings of the same original at once: all prompts are sent through
+    the LLM in a single batch, and only those whose response failed to parse are retried, again as a batch.
+
+    Responses are parsed in the order of rephrased_list, so already_used disambiguation is as if calling
+    find_supporting_quote for each in turn; of multiple candidates (n_candidates), the first that parses is used.
+    If align_threshold is given, only those that can't be confidently aligned without an LLM are sent to the LLM
+    (aligned can be given if this alignment was already done, e.g., by align_quotes in a separate process).
+    Returns a list of spans, None where max retries was reached.
+    """
+    if aligned is None and align_threshold is not None:
+        aligned = align_quotes(original, rephrased_list, align_threshold, only_from_char=only_from_char, already_used=already_used)
+    search = lambda used: _find_supporting_quotes(original, rephrased_list, pipe, n_retries, used, fuzzy, only_from_char, increase_temp, n_candidates, constrained, matcher, aligned)
+    key_parts = ('find_supporting_quotes', original, rephrased_list, n_retries, fuzzy, only_from_char, increase_temp, n_candidates, constrained, matcher, align_threshold)
+    return cached_quote_search(pipe, original, key_parts, already_used, search)
+
+
+def _find_supporting_quotes(original, rephrased_list, pipe, n_retries, already_used, fuzzy, only_from_char, increase_temp, n_candidates, constrained, matcher, aligned):
+    examples = EXAMPLE_LIBRARY.select(original)
+    chat_starts = [make_chat_start(PROMPT_FORMAT.format(original=original, rephrase=rephrased), examples, SYSTEM_PROMPT) for rephrased in rephrased_list]
+    raws = [None] * len(chat_starts)
+    errors = [[] for _ in chat_starts]
+    results = [None] * len(chat_starts)
+
+    if aligned is None:
+        aligned = [None] * len(chat_starts)
+    else:
+        logging.info('Aligned %d of %d subquestions without LLM.', len(aligned) - aligned.count(None), len(aligned))
+
+    to_generate = [i for i, spans in enumerate(aligned) if spans is None]
+    temperature = pipe.settings['temperature']
+    for n_try in range(0, n_retries + 1):
+        if to_generate and n_try > 0:
+            METRICS.count('attempts', len(to_generate))
+            for i, candidates in zip(to_generate, generate_candidates(pipe, [chat_starts[i] for i in to_generate], n_candidates, temperature=temperature,
+                                                                          grammar=QuoteGrammar(original) if constrained else None, stop=LineStop(),
+                                                                          max_new_tokens=token_budget(pipe, original))):
+                for raw in candidates:
+                    logging.info('(Subquestion %d, attempt %d): Model says: %s', i, n_try, OneLine(raw))
+                raws[i] = candidates
+            temperature += increase_temp
+
+        # Reparse everything in order, since a newly parsed quote may claim a span that a later one relied on:
+        used = None if already_used is None else spanmatch.UsedSpans(already_used)
+        to_generate = []
+        for i, candidates in enumerate(raws):
+            if aligned[i] is not None:
+                results[i] = aligned[i]
+                if used is not None:
+                    used.append((aligned[i][0]['start'], aligned[i][-1]['end']))
+                continue
+            if candidates is None:
+                to_generate.append(i)
+                continue
+            try:
+                results[i] = parse_candidates(candidates, functools.partial(parse_string_quote_as_spans, original=original, already_used=used, fuzzy=fuzzy, only_from_char=only_from_char, matcher=matcher), try_skip_first_line=False)
+            except ValueError as e:
+                results[i] = None
+                errors[i].append(str(e))
+                to_generate.append(i)
+
+        if not to_generate:
+            break
+
+    METRICS.count('failures', len(to_generate))
+    for i in to_generate:
+        logging.warning(f'Max number of retries ({"; ".join(errors[i])})')
+
+    if already_used is not None:
+        already_used.extend(used[len(already_used):])
+
+    return results
+
+
+def find_supporting_quote_batch(pairs, pipe, n_retries: int, batch_size=1, fuzzy=0.0, n_candidates=1, constrained=False, matcher='fast', align_threshold=None) -> list:
     """
-    Turn a quote string into a regular expression with optional fuzzy matching.
-    Each part of the quote string is put in a regex capturing group.
+    Like find_supporting_quote, but for many independent (original, rephrased) pairs, sending their prompts through
+    the LLM in batches (see retry_until_parse_batch). Returns spans per pair, None where max retries was reached.
+    """
+    if constrained:     # each original has its own grammar, which can't (yet) be applied within a single batch
+        return [find_supporting_quote(original, rephrased, pipe, n_retries, fail_ok=True, fuzzy=fuzzy, n_candidates=n_candidates,
+                                      constrained=True, matcher=matcher, align_threshold=align_threshold)
+                for original, rephrased in pairs]
+
+    results = [None] * len(pairs)
+    if align_threshold is not None:
+        results = [align_quotes(original, [rephrased], align_threshold)[0] for original, rephrased in pairs]
+
+    to_generate = [i for i, spans in enumerate(results) if spans is None]
+    chat_starts = [make_chat_start(PROMPT_FORMAT.format(original=pairs[i][0], rephrase=pairs[i][1]), EXAMPLE_LIBRARY.select(pairs[i][0]), SYSTEM_PROMPT) for i in to_generate]
+    parsers = [functools.partial(parse_string_quote_as_spans, original=pairs[i][0], fuzzy=fuzzy, matcher=matcher) for i in to_generate]
+    max_new_tokens = [token_budget(pipe, pairs[i][0]) for i in to_generate]
+    for i, spans in zip(to_generate, retry_until_parse_batch(pipe, chat_starts, parsers, n_retries, batch_size, try_skip_first_line=False, n_candidates=n_candidates,
+                                                             stop=LineStop(), max_new_tokens=max_new_tokens)):
+        results[i] = spans
+    return results
+
+
+def cached_quote_search(pipe, original, key_parts, already_used, search):
+    """
+    If the pipe has a response cache, looks up the result of search(already_used) there, replaying the spans it
+    added to already_used. Otherwise just calls search.
+
+    Besides key_parts, the key covers what else goes into generating for this original: the system prompt and
+    examples, and the generation settings, stop condition and token budget.
+
+    >>> import tempfile
+    >>> from backends import FakeBackend
+    >>> backend = FakeBackend(malformed_rate=0, preface_rate=0, temperature=.1, top_p=None, max_new_tokens=100)
+    >>> pipe = CachedPipe(backend, ResponseCache(tempfile.mkdtemp()), model_name='test')
+    >>> for _ in range(2):
+    ...     used = [(30, 40)]
+    ...     spans = find_supporting_quotes('Wat doe je? Wat doe je? Waarom?', ['Wat doe je?', 'Wat doe je?'], pipe, 2, already_used=used)
+    ...     print([(quote[0]['start'], quote[0]['end']) for quote in spans], used, backend.n_chats)
+    [(0, 11), (12, 23)] [(30, 40), (0, 11), (12, 23)] 2
+    [(0, 11), (12, 23)] [(30, 40), (0, 11), (12, 23)] 2
+    """
+    if (cached_pipe := find_cached_pipe(pipe)) is None:
+        return search(already_used)
 
-    fuzzy_max_e: max number of characters to change (as fuzzy * len(quote) becomes too big); bigger can mean (very) slow.
+    prompt = ResponseCache.make_key([SYSTEM_PROMPT, EXAMPLE_LIBRARY.select(original)])
+    settings = {**cached_pipe.key_settings(pipe.settings), 'max_new_tokens': token_budget(pipe, original), 'stop': LineStop.name}
+    key_parts = (*key_parts, already_used, prompt, settings)
 
-    >>> dotted_quote_to_regex("The quick brown ... over the ... dog", .2)
-    regex.Regex('(?:(The\\ quick\\ brown).+(over\\ the).+(dog)){e<=7}', flags=regex.B | regex.I | regex.V0)
-    """
-    quote_chunks = quote.split('...')
-    clean_quote_chunks = [regex.escape(chunk.strip()) for chunk in quote_chunks]
-    # make final question marks optional (because LLM often adds them):
-    regex_quote_chunks = [f'({chunk + ("?" if chunk.endswith("?") else "")})' for chunk in clean_quote_chunks]
-    the_regex_str = '(?:' + ('[^?]+'.join(regex_quote_chunks)) + ')'
+    def compute():
+        used = None if already_used is None else spanmatch.UsedSpans(already_used)
+        return {'spans': search(used), 'claimed': None if used is None else used[len(already_used):]}
+
+    result = cached_pipe.cached_result(key_parts, compute)
+    if already_used is not None:
+        already_used.extend(tuple(span) for span in result['claimed'])
+    return result['spans']
 
-    if fuzzy:
-        fuzzy_nchars = min(int(math.ceil(fuzzy * len(quote))), fuzzy_max_e)
-        the_regex_str += f'{{e<={fuzzy_nchars}}}'
 
-    return regex.compile(the_regex_str, flags=regex.IGNORECASE + regex.BESTMATCH)
+# TODO: Implement in-dialogue-retrying with feedback
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+from metrics import METRICS
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM responses (and of results derived from them, like quote spans), keyed by a hash of
+    everything that determines them. Least recently used entries are evicted once the cache exceeds max_size bytes.
+
+    >>> import tempfile
+    >>> cache = ResponseCache(tempfile.mkdtemp(), max_size=500)    # entries below take 64 + 38 bytes
+    >>> for name in 'abcd':
+    ...     cache.put(name, name * 36)
+    >>> _ = cache.get('a')     # now b is the least recently used
+    >>> cache.put('e', 'e' * 36)
+    >>> [name for name in 'abcde' if cache.get(name)], cache.total_size <= .9 * 500
+    (['a', 'c', 'd', 'e'], True)
+    """
+
+    def __init__(self, cache_dir, max_size=1_000_000_000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_size = max_size
+        # (may be used from another thread than the one creating it, though not concurrently, e.g., by stream.py)
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'qsep_cache.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+        self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    @staticmethod
+    def make_key(key_parts):
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key_parts):
+        key = self.make_key(key_parts)
+        row = self.db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute('UPDATE cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key_parts, value):
+        key = self.make_key(key_parts)
+        value = json.dumps(value, ensure_ascii=False)
+        size = len(key) + len(value)
+        with self.db:
+            old_size = self.db.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+        self.total_size += size - (old_size[0] if old_size else 0)
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is at most 90% of max_size (so as not to evict on each put).
+        """
+        target_size = .9 * self.max_size
+        n_evicted = 0
+        with self.db:
+            for key, size in self.db.execute('SELECT key, size FROM cache ORDER BY last_used').fetchall():
+                if self.total_size <= target_size:
+                    break
+                self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.total_size -= size
+                n_evicted += 1
+        logging.info('Evicted %d entries from response cache.', n_evicted)
+
+
+class CachedPipe:
+    """
+    Wraps a generation backend (see backends.py), only passing on the chats whose replies aren't already in the cache.
+
+    Only the generation settings in KEY_SETTINGS, the number of candidates and the names of the grammar and stop
+    condition (if any) are part of the key; others don't affect the replies.
+
+    >>> import tempfile
+    >>> from backends import FakeBackend
+    >>> from constraints import LineStop
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> chats = [[{'role': 'user', 'content': 'Wie ben je? En wat doe je?'}], [{'role': 'user', 'content': 'Hoe laat is het?'}]]
+    >>> backend = FakeBackend(temperature=.1, top_p=None, max_new_tokens=100)
+    >>> replies = CachedPipe(backend, ResponseCache(cache_dir), model_name='test').generate(chats)
+    >>> pipe = CachedPipe(backend, ResponseCache(cache_dir), model_name='test')     # e.g., a re-run
+    >>> pipe.generate(chats, batch_size=2) == replies, backend.n_chats
+    (True, 2)
+    >>> _ = pipe.generate(chats, temperature=.2), pipe.generate(chats, n_candidates=2), pipe.generate(chats, stop=LineStop()), pipe.generate(chats, max_new_tokens=50)
+    >>> backend.n_chats
+    10
+    """
+
+    KEY_SETTINGS = ('temperature', 'top_p', 'max_new_tokens')
+
+    def __init__(self, backend, cache: ResponseCache, model_name: str):
+        self.backend = backend
+        self.cache = cache
+        self.model_name = model_name
+
+    @property
+    def settings(self):
+        return self.backend.settings
+
+    def key_settings(self, settings):
+        settings = {**self.settings, **settings}
+        return {k: settings.get(k) for k in self.KEY_SETTINGS}
+
+    def count_tokens(self, text):
+        return self.backend.count_tokens(text)
+
+    def generate(self, chats, n_candidates=1, batch_size=None, grammar=None, stop=None, **settings):
+        key_settings = {**self.key_settings(settings), 'n_candidates': n_candidates, 'grammar': grammar and grammar.name, 'stop': stop and stop.name}
+        replies = [self.cache.get(('generate', self.model_name, chat, key_settings)) for chat in chats]
+        METRICS.count('cache_hits', len(replies) - replies.count(None))
+
+        if misses := [i for i, reply in enumerate(replies) if reply is None]:
+            for i, candidates in zip(misses, self.backend.generate([chats[i] for i in misses], n_candidates, batch_size=batch_size, grammar=grammar, stop=stop, **settings)):
+                replies[i] = candidates
+                self.cache.put(('generate', self.model_name, chats[i], key_settings), candidates)
+            logging.info('Response cache: %d hits, %d misses.', len(chats) - len(misses), len(misses))
+
+        return replies
+
+    def cached_result(self, key_parts, compute):
+        """
+        For caching things computed from (multiple) LLM responses, such as the spans found by find_supporting_quote.
+        """
+        key_parts = ('result', self.model_name, *key_parts)
+        if (result := self.cache.get(key_parts)) is None:
+            result = compute()
+            self.cache.put(key_parts, result)
+        return result
+
+
+def find_cached_pipe(pipe):
+    while not isinstance(pipe, CachedPipe):
+        if not hasattr(pipe, 'backend'):
+            return None
+        pipe = pipe.backend
+    return pipe
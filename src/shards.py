@@ -0,0 +1,142 @@
+"""
+Sharded runs over large input files: line n goes to shard n % n_shards, each shard runs in its own process (e.g., one
+per GPU, or per CPU socket), and results are appended to a per-shard journal (JSON lines, keyed by line number), so
+that an interrupted run can resume where each shard left off. The journals are merged back into input order.
+
+The run's options are kept alongside the journals (see check_meta), so that a run with different options doesn't
+resume from, or merge, results it wouldn't have produced.
+
+>>> import tempfile
+>>> journal_dir = tempfile.mkdtemp()
+>>> append_to_journal(journal_path(journal_dir, 0, 2), [{'n': 0, 'line': 'Wie?', 'result': ['Wie?']}, {'n': 2, 'line': 'Wat?', 'result': ['Wat?']}])
+>>> append_to_journal(journal_path(journal_dir, 1, 2), [{'n': 1, 'line': 'Hoe?', 'result': ['Hoe?']}])
+>>> with open(journal_path(journal_dir, 1, 2), 'a') as file:   # interrupted while writing a record
+...     _ = file.write('{"n": 3, "line": "Waar')
+>>> [(n, record['line']) for n, record in merge_journals(journal_dir, 2).items()]
+[(0, 'Wie?'), (1, 'Hoe?'), (2, 'Wat?')]
+>>> append_to_journal(journal_path(journal_dir, 1, 2), [{'n': 3, 'line': 'Waarom?', 'result': ['Waarom?']}])
+>>> list(read_journal(journal_path(journal_dir, 1, 2)))
+[1, 3]
+"""
+
+import os
+import json
+import logging
+import multiprocessing
+
+
+def journal_path(journal_dir, shard, n_shards):
+    return os.path.join(journal_dir, f'shard-{shard}-of-{n_shards}.jsonl')
+
+
+def shard_file(path, shard):
+    """
+    E.g., for a shard's own metrics file: metrics.json becomes metrics.shard-0.json.
+    """
+    if path is None:
+        return None
+    root, extension = os.path.splitext(path)
+    return f'{root}.shard-{shard}{extension}'
+
+
+def check_meta(journal_dir, meta) -> bool:
+    """
+    Whether the journals in journal_dir were written with the given meta (e.g., the options that affect results); if
+    there are no journals yet, the meta is recorded, for later runs to check against.
+
+    >>> import tempfile
+    >>> journal_dir = tempfile.mkdtemp()
+    >>> check_meta(journal_dir, {'validate': True}), check_meta(journal_dir, {'validate': True}), check_meta(journal_dir, {'validate': False})
+    (True, True, False)
+    """
+    path = os.path.join(journal_dir, 'meta.json')
+    os.makedirs(journal_dir, exist_ok=True)
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file) == json.loads(json.dumps(meta))
+    with open(path, 'w') as file:
+        json.dump(meta, file, indent=2)
+    return True
+
+
+def read_journal(path) -> dict:
+    """
+    Records by line number. A final record that was cut off (by an interruption) is removed from the file, so that
+    new records can be appended.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'rb+') as file:
+        complete_until = 0
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            records[record['n']] = record
+            complete_until += len(line)
+        if complete_until < file.seek(0, os.SEEK_END):
+            logging.warning(f'Removing incomplete record from {path}')
+            file.truncate(complete_until)
+    return records
+
+
+def append_to_journal(path, records):
+    with open(path, 'a', encoding='utf-8') as file:
+        for record in records:
+            file.write(json.dumps(record) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def set_device(device):
+    """
+    A device is either a GPU number (e.g., '0'), or a range of CPUs (e.g., 'cpus:0-15') to pin the process to.
+    """
+    if device.startswith('cpus:'):
+        first, last = device.removeprefix('cpus:').split('-')
+        os.sched_setaffinity(0, range(int(first), int(last) + 1))
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+
+
+def run_worker(worker, device, *args):
+    if device is not None:
+        set_device(device)
+    worker(*args)
+
+
+def run_sharded(worker, journal_dir, n_shards, devices=None):
+    """
+    Calls worker(shard, n_shards, journal_path) for each shard in a separate process, with shard k on
+    devices[k % len(devices)] (if given), and waits for all. Returns the shards that failed.
+    """
+    os.makedirs(journal_dir, exist_ok=True)
+    context = multiprocessing.get_context('spawn')  # each loads its own model; nothing to inherit
+    processes = []
+    for shard in range(n_shards):
+        device = devices[shard % len(devices)] if devices else None
+        process = context.Process(target=run_worker, args=(worker, device, shard, n_shards, journal_path(journal_dir, shard, n_shards)))
+        process.start()
+        processes.append(process)
+
+    failed = []
+    for shard, process in enumerate(processes):
+        process.join()
+        if process.exitcode != 0:
+            logging.warning(f'Shard {shard} failed (exit code {process.exitcode}); run again to resume.')
+            failed.append(shard)
+    return failed
+
+
+def merge_journals(journal_dir, n_shards) -> dict:
+    """
+    Records by line number, in order.
+    """
+    records = {}
+    for shard in range(n_shards):
+        records.update(read_journal(journal_path(journal_dir, shard, n_shards)))
+    return dict(sorted(records.items()))
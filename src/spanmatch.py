@@ -0,0 +1,239 @@
+"""
+Fast matching of (dotted) quotes against the original text, as an alternative to dotted_quote_to_regex's fuzzy
+regular expressions: exact search first, then a bit-parallel approximate search (Myers, 1999) for each chunk,
+raising the error budget step by step until something matches.
+
+Semantics follow the regex: chunks are separated by '...' in the quote, and by at least one character other than
+'?' in the original; a chunk's final question mark is optional; matching is case-insensitive.
+"""
+
+import math
+import functools
+
+
+class QuoteMatch:
+    """
+    Mimics the bits of regex's Match object that parse_string_quote_as_spans uses; group n is the nth chunk.
+    """
+
+    def __init__(self, text, spans, n_errors, length_diff=0):
+        self.text = text
+        self.spans = spans
+        self.n_errors = n_errors
+        self.length_diff = length_diff
+
+    def span(self, n=0):
+        return (self.spans[0][0], self.spans[-1][1]) if n == 0 else self.spans[n - 1]
+
+    def group(self, n=0):
+        start, end = self.span(n)
+        return self.text[start:end]
+
+    def groups(self):
+        return tuple(self.group(n) for n in range(1, len(self.spans) + 1))
+
+    def __repr__(self):
+        return f'<QuoteMatch span={self.span()} errors={self.n_errors} groups={self.groups()}>'
+
+
+class UsedSpans(list):
+    """
+    List of (start, end) spans with O(1) membership tests, for the already_used argument of
+    parse_string_quote_as_spans. Still serializes (e.g., to json) as a plain list.
+
+    >>> used = UsedSpans([(4, 7)])
+    >>> used.append((17, 20))
+    >>> (17, 20) in used, (5, 7) in used, used
+    (True, False, [(4, 7), (17, 20)])
+    """
+
+    def __init__(self, spans=()):
+        super().__init__(tuple(span) for span in spans)
+        self.span_set = set(self)
+
+    def append(self, span):
+        super().append(tuple(span))
+        self.span_set.add(tuple(span))
+
+    def extend(self, spans):
+        for span in spans:
+            self.append(span)
+
+    def __contains__(self, span):
+        return tuple(span) in self.span_set
+
+
+def supports(quote: str, text: str) -> bool:
+    """
+    Lower-casing must not change string lengths (as it would for, e.g., 'İ'), and chunks must be non-empty.
+    """
+    return (len(quote.lower()) == len(quote) and len(text.lower()) == len(text)
+            and all(chunk.strip() for chunk in quote.split('...')))
+
+
+def find_quote_matches(quote: str, text: str, fuzzy=0.0, fuzzy_max_e=7, min_start=0) -> list[QuoteMatch]:
+    """
+    Returns non-overlapping matches (sorted by position) at the lowest number of errors for which any match
+    starts at or after min_start; if no such match exists, those at the lowest number of errors for which there is
+    any match at all. The max number of errors is as in dotted_quote_to_regex.
+
+    >>> find_quote_matches('de grote ... was lui', 'de grote grijze vos was lui')
+    [<QuoteMatch span=(0, 27) errors=0 groups=('de grote', 'was lui')>]
+    >>> find_quote_matches('de grote ... was lui', 'de grooote grijze vos was lui', fuzzy=.2)
+    [<QuoteMatch span=(0, 29) errors=2 groups=('de grooo', 'was lui')>]
+    >>> find_quote_matches('def', 'abc def ghij abc def ghij')
+    [<QuoteMatch span=(4, 7) errors=0 groups=('def',)>, <QuoteMatch span=(17, 20) errors=0 groups=('def',)>]
+    >>> find_quote_matches('And when?', 'What for? And why? And if so, when?')
+    []
+    """
+    max_errors = min(int(math.ceil(fuzzy * len(quote))), fuzzy_max_e) if fuzzy else 0
+    chunks = [chunk.strip().lower() for chunk in quote.split('...')]
+    lower_text = text.lower()
+
+    # [^?]+ between chunks means a chunk must start before the next question mark after the previous chunk:
+    next_question_mark = [len(text)] * (len(text) + 1)
+    for i in range(len(text) - 1, -1, -1):
+        next_question_mark[i] = i if text[i] == '?' else next_question_mark[i + 1]
+
+    distances = None
+    fallback = []
+    for n_errors in range(max_errors + 1):
+        if n_errors == 1:   # only compute approximate distances when exact search has failed
+            distances = [chunk_distances(chunk.rstrip('?'), lower_text) for chunk in chunks]
+        occurrences = [find_occurrences(chunk, lower_text, n_errors, distances and distances[i])
+                       for i, chunk in enumerate(chunks)]
+        matches = combine_occurrences(text, occurrences, n_errors, next_question_mark)
+        if any(match.span()[0] >= min_start for match in matches):
+            return matches
+        fallback = fallback or matches
+
+    return fallback
+
+
+def find_occurrences(chunk, lower_text, max_errors, distances=None) -> list[tuple[int, int, int, int]]:
+    """
+    Returns (start, end, n_errors, length difference) for each occurrence of the chunk with at most max_errors,
+    absorbing a final question mark in the text if the chunk ends with one.
+    """
+    pattern = chunk.rstrip('?')
+    absorb_question_mark = pattern != chunk
+    occurrences = []
+
+    if not max_errors:
+        start = lower_text.find(pattern)
+        while start != -1:
+            occurrences.append((start, start + len(pattern), 0, 0))
+            start = lower_text.find(pattern, start + 1)
+    else:
+        for end, distance in enumerate(distances):
+            if distance <= max_errors and end > 0:
+                start = best_start(pattern, lower_text, end, distance)
+                occurrences.append((start, end, distance, abs(end - start - len(pattern))))
+
+    if absorb_question_mark:
+        occurrences = [(start, end + 1 if lower_text[end:end + 1] == '?' else end, n_errors, length_diff)
+                       for start, end, n_errors, length_diff in occurrences]
+    return occurrences
+
+
+def combine_occurrences(text, occurrences, max_errors, next_question_mark) -> list[QuoteMatch]:
+    """
+    Chains occurrences of consecutive chunks into matches of the whole quote (with at most max_errors in total),
+    then keeps the best non-overlapping ones. Like the regex's greedy [^?]+, later occurrences of subsequent chunks
+    are preferred.
+    """
+    later_chunks = [sorted(chunk_occurrences, key=lambda o: (o[2], -o[0], o[3])) for chunk_occurrences in occurrences[1:]]
+
+    @functools.cache
+    def complete(n, prev_end, budget):
+        if n == len(later_chunks):
+            return ()
+        for start, end, n_errors, length_diff in later_chunks[n]:
+            if n_errors <= budget and prev_end < start <= next_question_mark[prev_end]:
+                if (rest := complete(n + 1, end, budget - n_errors)) is not None:
+                    return ((start, end, n_errors, length_diff), *rest)
+        return None
+
+    candidates = []
+    for first in occurrences[0]:
+        if (rest := complete(0, first[1], max_errors - first[2])) is not None:
+            chain = [first, *rest]
+            candidates.append(QuoteMatch(text, [(start, end) for start, end, *_ in chain],
+                                         sum(o[2] for o in chain), sum(o[3] for o in chain)))
+
+    matches = []
+    taken = []
+    for candidate in sorted(candidates, key=lambda m: (m.n_errors, m.span()[0], m.length_diff)):
+        start, end = candidate.span()
+        if all(end <= other_start or start >= other_end for other_start, other_end in taken):
+            matches.append(candidate)
+            taken.append((start, end))
+
+    return sorted(matches, key=lambda m: m.span())
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern: str) -> dict:
+    """
+    Bitmask per character of where it occurs in the pattern (Python ints serve as bit vectors of any length).
+    """
+    masks = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    return masks
+
+
+def chunk_distances(pattern: str, text: str) -> list[int]:
+    """
+    Myers' bit-parallel algorithm: for each end position in text, the minimal edit distance between pattern and a
+    substring of text ending there.
+
+    >>> chunk_distances('grote', 'de grooote')
+    [5, 5, 4, 5, 4, 3, 2, 2, 2, 3, 2]
+    """
+    m = len(pattern)
+    if not m:
+        return [0] * (len(text) + 1)
+    masks = compile_pattern(pattern)
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    positive, negative, score = full, 0, m
+    distances = [m]
+    for char in text:
+        eq = masks.get(char, 0)
+        xv = eq | negative
+        xh = (((eq & positive) + positive) ^ positive) | eq
+        horizontal_positive = negative | (~(xh | positive) & full)
+        horizontal_negative = positive & xh
+        if horizontal_positive & high:
+            score += 1
+        elif horizontal_negative & high:
+            score -= 1
+        horizontal_positive = (horizontal_positive << 1) & full
+        horizontal_negative = (horizontal_negative << 1) & full
+        positive = horizontal_negative | (~(xv | horizontal_positive) & full)
+        negative = horizontal_positive & xv
+        distances.append(score)
+    return distances
+
+
+def best_start(pattern: str, text: str, end: int, distance: int) -> int:
+    """
+    Given that pattern matches text ending at end with the given (minimal) distance, find the start position,
+    preferring a matched length closest to the pattern's length.
+
+    >>> best_start('grote', 'de grooote', 8, 2)
+    3
+    """
+    m = len(pattern)
+    window = text[max(0, end - m - distance):end][::-1]
+    reversed_pattern = pattern[::-1]
+    # column[j]: edit distance between the reversed pattern so far and the first j characters of the window
+    column = list(range(len(window) + 1))
+    for i, char in enumerate(reversed_pattern, start=1):
+        new_column = [i]
+        for j, text_char in enumerate(window, start=1):
+            new_column.append(min(column[j - 1] + (char != text_char), column[j] + 1, new_column[j - 1] + 1))
+        column = new_column
+    candidates = [j for j, d in enumerate(column) if d == distance] or [min(range(len(column)), key=column.__getitem__)]
+    return end - min(candidates, key=lambda j: abs(j - m))
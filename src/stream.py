@@ -0,0 +1,125 @@
+"""
+Streaming mode for qsep: reading, LLM splitting, span alignment, LLM validation and writing run as concurrent
+stages connected by bounded queues, so that, e.g., the CPU-bound alignment of one batch's subquestions (in a pool of
+worker processes) overlaps with generation for the next batch, and output is written as soon as it's in order.
+
+At most max_in_flight lines are between reading and writing at any time, so a slow stage makes the reader wait
+(backpressure) rather than letting buffers grow; the writer restores input order with a reorder buffer.
+
+The stages are given as plain (blocking) functions; LLM calls all run in a single thread, one at a time. For qsep,
+matching the LLM's quotes to the original happens within validation, hence in that thread too: it's interleaved with
+retries, and (see spanmatch.py) cheap compared to generation, unlike alignment without LLM.
+
+>>> import json, time
+>>> from backends import FakeBackend
+>>> backend = FakeBackend(malformed_rate=0, preface_rate=0)
+>>> n_read, validated, written, in_flight = [0], [], [], []
+>>> def read_lines():
+...     for n, line in enumerate(['Wie? Wat? Waar?', 'Hoe?', 'Wat?', 'Waar?', 'Wanneer?', 'Waarom?']):
+...         n_read[0] += 1
+...         yield n, line
+>>> def split(batch):   # with a delay for alignment: half a second per subquestion after the first
+...     replies = backend.generate([[{'role': 'user', 'content': line}] for n, line in batch])
+...     return [(len(json.loads(candidates[0])) - 1) / 2 for candidates in replies]
+>>> def validate(result, aligned):
+...     validated.append(result)
+...     return result
+>>> def write(n, line, result):
+...     in_flight.append(n_read[0] - len(written))
+...     written.append(n)
+>>> run_streaming(read_lines(), split, write, align=time.sleep, validate=validate, max_in_flight=3)
+>>> validated, written, max(in_flight)
+([0.0, 0.0, 1.0, 0.0, 0.0, 0.0], [0, 1, 2, 3, 4, 5], 3)
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import logging
+
+DONE = object()
+
+
+def run_streaming(numbered_lines, split, write, align=None, validate=None, batch_size=1, max_in_flight=64, n_workers=2):
+    """
+    Per line, with n its number and line its text:
+    - split(list of (n, line)) returns a result per line (in batches of up to batch_size lines);
+    - align(result) is run in a worker process (so it must be picklable) if the result isn't None;
+    - validate(result, aligned) turns it into the final result if the result isn't None;
+    - write(n, line, result) is called in order of n (which must count from 0).
+    """
+    asyncio.run(stream(numbered_lines, split, write, align, validate, batch_size, max_in_flight, n_workers))
+
+
+async def stream(numbered_lines, split, write, align, validate, batch_size, max_in_flight, n_workers):
+    in_flight = asyncio.Semaphore(max_in_flight)
+    to_split, to_align, to_validate, to_write = (asyncio.Queue(max_in_flight) for _ in range(4))
+    llm_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    # spawn rather than fork, to not copy (and corrupt) the state of a process that has a model on the GPU:
+    align_pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) if align else None
+    loop = asyncio.get_running_loop()
+
+    async def read():
+        lines = iter(numbered_lines)
+        while True:
+            await in_flight.acquire()   # (before reading, so as not to read ahead either)
+            if (item := await loop.run_in_executor(None, next, lines, DONE)) is DONE:
+                break
+            await to_split.put(item)
+        await to_split.put(DONE)
+
+    async def split_batches():
+        done = False
+        while not done:
+            # take whatever is waiting (up to batch_size) rather than waiting for a full batch:
+            batch = [await to_split.get()]
+            while len(batch) < batch_size and not to_split.empty():
+                batch.append(to_split.get_nowait())
+            if batch[-1] is DONE:
+                done = True
+                batch.pop()
+            if batch:
+                results = await loop.run_in_executor(llm_thread, split, batch)
+                for (n, line), result in zip(batch, results):
+                    await to_align.put((n, line, result))
+        for _ in range(n_workers):
+            await to_align.put(DONE)
+
+    async def align_results():
+        while (item := await to_align.get()) is not DONE:
+            n, line, result = item
+            aligned = await loop.run_in_executor(align_pool, align, result) if align and result is not None else None
+            await to_validate.put((n, line, result, aligned))
+        await to_validate.put(DONE)
+
+    async def validate_results():
+        n_running = n_workers
+        while n_running:
+            if (item := await to_validate.get()) is DONE:
+                n_running -= 1
+                continue
+            n, line, result, aligned = item
+            if validate and result is not None:
+                result = await loop.run_in_executor(llm_thread, validate, result, aligned)
+            await to_write.put((n, line, result))
+        await to_write.put(DONE)
+
+    async def write_in_order():
+        waiting = {}
+        next_n = 0
+        while (item := await to_write.get()) is not DONE:
+            waiting[item[0]] = item
+            while next_n in waiting:
+                write(*waiting.pop(next_n))
+                next_n += 1
+                in_flight.release()
+        if waiting:
+            logging.warning(f'{len(waiting)} lines were never written (non-consecutive line numbers?)')
+
+    try:
+        await asyncio.gather(read(), split_batches(), *(align_results() for _ in range(n_workers)),
+                             validate_results(), write_in_order())
+    finally:
+        llm_thread.shutdown(wait=False, cancel_futures=True)
+        if align_pool:
+            align_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,63 @@
+"""
+Generation with a prefix cache (see llm_utils.PrefixCache) should give the same replies as without, on a real (tiny,
+randomly initialized) transformers model, built locally so no download is needed. Skipped without torch.
+
+    cd src; python -m pytest test_prefix_cache.py
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from backends import PipelineBackend
+from llm_utils import PREFIX_CACHES, make_chat_start, register_prefix_cache, find_prefix_cache, prepare_for_batching
+
+EXAMPLES = [{'prompt': 'Wie ben je en wat doe je?', 'response': '["Wie ben je?", "Wat doe je?"]'}]
+SYSTEM_PROMPT = 'Split the question.'
+CHAT_TEMPLATE = ("{% for message in messages %}<{{ message['role'] }}>{{ message['content'] }}\n{% endfor %}"
+                 "{% if add_generation_prompt %}<assistant>{% endif %}")
+
+
+@pytest.fixture(scope='module')
+def pipe():
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    corpus = [SYSTEM_PROMPT, *(example[key] for example in EXAMPLES for key in ('prompt', 'response')), 'Hoe laat is het?']
+    tokenizer.train_from_iterator(corpus * 10, trainers.BpeTrainer(vocab_size=300, special_tokens=['</s>'], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='</s>')
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                                      num_key_value_heads=2, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.eos_token_id)
+    model = transformers.LlamaForCausalLM(config)
+    generator = prepare_for_batching(transformers.pipeline('text-generation', model=model, tokenizer=tokenizer))
+    yield PipelineBackend(generator, max_new_tokens=12, do_sample=False)
+    PREFIX_CACHES.clear()
+
+
+@pytest.mark.parametrize('n_candidates', [1, 3])
+def test_same_replies_with_prefix_cache(pipe, n_candidates):
+    chats = [make_chat_start(prompt, EXAMPLES, SYSTEM_PROMPT) for prompt in ['Hoe laat is het?', 'Waar en wanneer was dat?']]
+
+    PREFIX_CACHES.clear()
+    torch.manual_seed(1)    # (for n_candidates > 1, which samples)
+    without_cache = [pipe.generate([chat], n_candidates)[0] for chat in chats]
+
+    prefix_cache = register_prefix_cache(pipe, 'test', EXAMPLES, SYSTEM_PROMPT)
+    assert all(find_prefix_cache(pipe, chat) is prefix_cache for chat in chats)
+    torch.manual_seed(1)
+    with_cache = pipe.generate(chats, n_candidates)    # (one chat at a time, in the same order as above)
+
+    assert [len(candidates) for candidates in with_cache] == [n_candidates] * len(chats)
+    assert with_cache == without_cache
+
+    # That the cache is actually used: corrupting it changes the replies.
+    for layer in prefix_cache.past_key_values.layers:
+        layer.values.normal_(std=10)
+    torch.manual_seed(1)
+    assert pipe.generate(chats, n_candidates) != without_cache